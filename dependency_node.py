@@ -14,29 +14,66 @@
 
 import os
 import queue
+import threading
+import contextlib
+from collections import deque
 import concurrent.futures
 
+def null_completion_func(*args, **kwargs):
+	return
+
+def call_completion_func(node):
+	node.completion_func(*node.completion_args, **node.completion_kwargs)
+	return
+
 ## This object manages chains of dependencies.
 # It's intended as a base class.
 # The object uses executor to manage serialization of calls
 class dependency_node:
+	# Subclasses which don't declare __slots__ get their own __dict__
+	__slots__ = ('depends_on', 'dependents', 'is_ready', 'is_completed', 'is_cancelled',
+				'completion_func', 'completion_args', 'completion_kwargs', 'executor')
+
+	# Per-thread defaults for new nodes which don't have dependencies
+	# or an explicit executor, set by use_executor() and use_futures_executor()
+	_thread_defaults = threading.local()
+
 	def __init__(self, *initial_dependencies, executor = None):
-		# list of nodes depending on this object
-		self.depends_on = []
-		# list of nodes which depend on this node
-		self.dependents = []
+		# nodes this object depends on.
+		# A dict is used as an insertion-ordered set, for O(1) removal
+		self.depends_on = {}
+		# nodes which depend on this node
+		self.dependents = {}
 		# self.is_ready means the node could be executed, unless it depends on other uncompleted nodes
 		self.is_ready = False
 		# self.is_completed means its dependents can proceed immediately
 		self.is_completed = False
 		self.is_cancelled = False
-		self.completion_func = None
+		self.completion_func = null_completion_func
+		self.completion_args = ()
+		self.completion_kwargs = {}
 		if initial_dependencies:
 			self.executor = initial_dependencies[0].executor
-			for dep in initial_dependencies:
-				self.add_dependency(dep)
-		else:
+			self.add_dependencies(initial_dependencies)
+		elif executor is not None:
 			self.executor = executor
+		else:
+			self.executor = getattr(dependency_node._thread_defaults, 'executor', None)
+		return
+
+	## Use as 'with dependency_node.use_executor(executor):'
+	# to make the executor default for new nodes created in this context,
+	# only in the current thread
+	@staticmethod
+	@contextlib.contextmanager
+	def use_executor(executor):
+		thread_defaults = dependency_node._thread_defaults
+		prev_executor = getattr(thread_defaults, 'executor', None)
+		thread_defaults.executor = executor
+		try:
+			yield executor
+		finally:
+			thread_defaults.executor = prev_executor
 		return
 
 	## An object adds dependency when it cannot proceed without
@@ -44,8 +81,16 @@ class dependency_node:
 	def add_dependency(self, dependency):
 		assert(not self.is_completed)
 		if not dependency.is_completed:
-			self.depends_on.append(dependency)
-			dependency.dependents.append(self)
+			self.depends_on[dependency] = None
+			dependency.dependents[self] = None
+		return
+
+	def add_dependencies(self, dependencies):
+		assert(not self.is_completed)
+		pending = [dep for dep in dependencies if not dep.is_completed]
+		self.depends_on.update(dict.fromkeys(pending))
+		for dep in pending:
+			dep.dependents[self] = None
 		return
 
 	## When an object's dependency is all done,
@@ -53,14 +98,16 @@ class dependency_node:
 	# If the list becomes empty, the object becomes unblocked
 	# and can proceed with execution
 	def dependency_done(self, dependency):
-		self.depends_on.remove(dependency)
+		self.depends_on.pop(dependency, None)
 		if not self.blocked():
 			self.unblocked()
 		return
 
 	def release_all_dependents(self):
-		while self.dependents:
-			dependent = self.dependents.pop(-1)
+		dependents = self.dependents
+		self.dependents = {}
+		# Dependents are released in reverse order
+		for dependent in reversed(dependents):
 			dependent.dependency_done(self)
 		return
 
@@ -83,7 +130,9 @@ class dependency_node:
 		return
 
 	def blocked(self):
-		return not (self.is_ready or self.is_cancelled) or len(self.depends_on) != 0
+		if self.depends_on:
+			return True
+		return not (self.is_ready or self.is_cancelled)
 
 	def unblocked(self):
 		self.executor.add_to_completion(self)
@@ -94,8 +143,7 @@ class dependency_node:
 		# Is called by the executor when all dependencies are done
 		# An overloaded function will eventually call completed()
 		# to unblock all dependents
-		if self.completion_func:
-			self.completion_func(*self.completion_args, **self.completion_kwargs)
+		self.completion_func(*self.completion_args, **self.completion_kwargs)
 		return self.completed()
 
 	def cancel(self, force=False):
@@ -109,53 +157,101 @@ class dependency_node:
 		return
 
 	def do_cancel(self):
-		# Detach from all items this one depends on.
-		# This only happens if this item has been cancelled with force=True
-		if self.depends_on:
-			list_to_detach = self.depends_on
-			self.depends_on = []
-			for item in list_to_detach:
-				item.dependents.remove(self)
-
-		# cancel all items which depend in this
-		list_to_cancel = self.dependents
-		self.dependents = []
-
-		for item in list_to_cancel:
-			item.depends_on.remove(self)
-			item.cancel()
-
-		return self.on_cancel()
+		# Dependents which become unblocked by the cancellation
+		# are cancelled in this same call, in order of their unblocking,
+		# instead of going through the executor queue one by one
+		worklist = deque((self,))
+		while worklist:
+			node = worklist.popleft()
+			# Detach from all items this one depends on.
+			# This only happens if this item has been cancelled with force=True
+			if node.depends_on:
+				list_to_detach = node.depends_on
+				node.depends_on = {}
+				for item in list_to_detach:
+					item.dependents.pop(node, None)
+
+			# cancel all items which depend in this
+			list_to_cancel = node.dependents
+			node.dependents = {}
+
+			for item in list_to_cancel:
+				item.depends_on.pop(node, None)
+				if item.is_completed:
+					continue
+				item.is_cancelled = True
+				item.is_ready = False
+				# An item still blocked by other dependencies
+				# will be cancelled by the executor when unblocked.
+				# An item of another executor is cancelled by its own executor
+				if not item.blocked():
+					if item.executor is node.executor:
+						worklist.append(item)
+					else:
+						item.executor.add_to_completion(item)
+				continue
+
+			node.on_cancel()
+		return
 
 	def on_cancel(self):
 		return
 
 class executor():
-	def __init__(self):
-		self.queue = []
+	# pool is an optional concurrent.futures executor.
+	# If present, a batch of ready nodes is dispatched to it in parallel.
+	def __init__(self, pool=None):
+		self.queue = deque()
+		self.pool = pool
+		self.is_cancelled = False
 		return
 
 	def add_to_completion(self, dep_node: dependency_node):
 		self.queue.append(dep_node)
 		return
 
+	# Futures are materialized by async_workitem.result()
+	add_future_completion = add_to_completion
+
+	def run_node(self, node):
+		# An overloaded function will call completed()
+		# to unblock all dependents of this node
+		if node.is_cancelled:
+			node.do_cancel()
+		elif self.is_cancelled:
+			node.cancel()
+		else:
+			node.complete()
+		return
+
 	def run(self, existing_only=False):
 		to_execute = self.queue
 		if not to_execute:
 			return False
 
+		run_node = self.run_node
+		pool = self.pool
 		while to_execute:
-			self.queue = []
-
-			for node in to_execute:
-				# An overloaded function will call completed()
-				# to unblock all dependents of this node
-				if node.is_cancelled:
-					node.do_cancel()
-				elif self.is_cancelled:
-					node.cancel()
-				else:
-					node.complete()
+			self.queue = deque()
+
+			if pool is not None and len(to_execute) > 1 and not self.is_cancelled:
+				# Nodes in the queue don't depend on each other,
+				# thus their functions can be called concurrently.
+				# The workers only call the functions. The nodes are completed
+				# and their dependents released in this thread, in queue order.
+				# Nodes with an overloaded complete() are run here as usual
+				to_call = dict.fromkeys(node for node in to_execute
+						if not node.is_cancelled and type(node).complete is dependency_node.complete)
+				for _ in pool.map(call_completion_func, to_call): pass
+				for node in to_execute:
+					if node in to_call:
+						node.completed()
+					else:
+						run_node(node)
+					continue
+			else:
+				for node in to_execute:
+					run_node(node)
 			if existing_only:
 				break
 			to_execute = self.queue
@@ -164,13 +260,27 @@ class executor():
 
 # async_executor will read items to execute from a synchronized queue
 # instead of a simple list.
+# Ready items posted by the thread which created the executor (and which is expected to run it)
+# go to a thread-local deque, which doesn't need a lock.
+# Items with a future to materialize, and items posted by other threads,
+# go to the synchronized queue.
 class async_executor(dependency_node):
 	def __init__(self):
 		super().__init__(executor=self)
 		self.completion_queue = queue.SimpleQueue()
+		self.local = threading.local()
+		self.local.queue = deque()
 		return
 
 	def add_to_completion(self, dep_node: dependency_node):
+		local_queue = getattr(self.local, 'queue', None)
+		if local_queue is not None:
+			local_queue.append(dep_node)
+		else:
+			self.completion_queue.put(dep_node)
+		return
+
+	def add_future_completion(self, dep_node: dependency_node):
 		self.completion_queue.put(dep_node)
 		return
 
@@ -178,47 +288,73 @@ class async_executor(dependency_node):
 		if self.is_completed:
 			block = False
 
-		to_execute = self.completion_queue.qsize()
-		if not block and not to_execute:
-			return False
+		local_queue = getattr(self.local, 'queue', None)
+		if local_queue is None:
+			local_queue = deque()
 
-		if not existing_only:
+		qsize = self.completion_queue.qsize
+		if not (block or existing_only):
+			# Drain both queues until empty, without probing their size first
 			to_execute = -1
-		elif to_execute == 0:
-			to_execute = 1
-
+		else:
+			to_execute = qsize() + len(local_queue)
+			if not block and not to_execute:
+				return False
+
+			if not existing_only:
+				to_execute = -1
+			elif to_execute == 0:
+				to_execute = 1
+
+		executed = False
+		is_cancelled = self.is_cancelled
+		popleft = local_queue.popleft
+		get = self.completion_queue.get
 		while to_execute != 0:
-			try:
-				node = self.completion_queue.get(block=block)
-			except queue.Empty:
+			if local_queue:
+				# Items in the local queue don't have a future
+				node = popleft()
+			elif block or qsize():
+				# This is the only consumer of the queue.
+				# If it's not empty, get() doesn't wait.
+				node = get()
+				future = getattr(node, 'future', None)
+				if future:
+					if future.cancelled():
+						node.is_cancelled = True
+					elif is_cancelled:
+						node.is_cancelled = True
+					else:
+						try:
+							node.future_result = future.result()
+						except BrokenPipeError:
+							node.future_result = None
+					node.future = None
+			else:
 				break
+
 			# An overloaded function will call completed()
 			# to unblock all dependents of this node
-			future = getattr(node, 'future', None)
-			if future:
-				if future.cancelled():
-					node.is_cancelled = True
-				elif self.is_cancelled:
-					node.is_cancelled = True
-				else:
-					try:
-						node.future_result = future.result()
-					except BrokenPipeError:
-						node.future_result = None
-				node.future = None
-
 			if node.is_cancelled:
 				node.do_cancel()
-			elif self.is_cancelled:
+				# The executor itself can be cancelled by the cascade
+				is_cancelled = self.is_cancelled
+			elif is_cancelled:
 				node.cancel()
 			else:
 				node.complete()
+			executed = True
+			# Only wait for the first item
 			block = False
 			to_execute -= 1
-		return True
+		return executed
 
 class async_workitem(dependency_node):
+	__slots__ = ('futures_executor', 'future', 'future_result',
+				'async_func', 'async_args', 'async_kwargs', 'async_inline')
+
 	_futures_executor = None
+	_default_max_workers = None
 
 	def __init__(self, *dependencies, executor=None, futures_executor=None):
 		super().__init__(*dependencies, executor=executor)
@@ -226,14 +362,49 @@ class async_workitem(dependency_node):
 			self.futures_executor = dependencies[0].futures_executor
 		elif futures_executor:
 			self.futures_executor = futures_executor
+		elif getattr(dependency_node._thread_defaults, 'futures_executor', None):
+			self.futures_executor = dependency_node._thread_defaults.futures_executor
 		elif self._futures_executor:
 			self.futures_executor = async_workitem._futures_executor
 		else:
-			async_workitem._futures_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(4, min(16, os.cpu_count())))
+			if not async_workitem._default_max_workers:
+				async_workitem.configure_pool()
+			async_workitem._futures_executor = concurrent.futures.ThreadPoolExecutor(
+								max_workers=async_workitem._default_max_workers)
 			self.futures_executor = async_workitem._futures_executor
 		self.future = None
 		self.future_result = None
 		self.async_func = None
+		self.async_inline = False
+		return
+
+	## Use as 'with async_workitem.use_futures_executor(futures_executor):'
+	# to make the futures executor default for new items created in this context,
+	# only in the current thread
+	@staticmethod
+	@contextlib.contextmanager
+	def use_futures_executor(futures_executor):
+		thread_defaults = dependency_node._thread_defaults
+		prev_futures_executor = getattr(thread_defaults, 'futures_executor', None)
+		thread_defaults.futures_executor = futures_executor
+		try:
+			yield futures_executor
+		finally:
+			thread_defaults.futures_executor = prev_futures_executor
+		return
+
+	## Sets number of workers for the default thread pool, which is created on first use.
+	# io_bound=True allows more threads, for functions which mostly wait
+	# for I/O or a child process, and don't hold GIL
+	@staticmethod
+	def configure_pool(max_workers=None, io_bound=False):
+		if not max_workers:
+			cpu_count = os.cpu_count() or 4
+			if io_bound:
+				max_workers = min(32, cpu_count * 4)
+			else:
+				max_workers = max(4, min(16, cpu_count))
+		async_workitem._default_max_workers = max_workers
 		return
 
 	def shutdown():
@@ -242,7 +413,10 @@ class async_workitem(dependency_node):
 			async_workitem._futures_executor = None
 
 	def async_completion_callback(self, future):
-		self.executor.add_to_completion(self)
+		if future is None:
+			self.executor.add_to_completion(self)
+		else:
+			self.executor.add_future_completion(self)
 		return
 
 	def unblocked(self):
@@ -251,8 +425,20 @@ class async_workitem(dependency_node):
 		if not self.async_func:
 			return self.async_completion_callback(None)
 		assert(self.future is None)
+		if self.async_inline:
+			# A short function is called right away, without a round trip through the thread pool
+			try:
+				self.future_result = self.async_func(*self.async_args, **self.async_kwargs)
+			except BrokenPipeError:
+				self.future_result = None
+			self.async_func = None
+			return self.async_completion_callback(None)
+		# The function is submitted right away, not batched until the next run() pass:
+		# items are also unblocked while the history is being read, outside of run()
 		self.future = self.futures_executor.submit(self.async_func, *self.async_args, **self.async_kwargs)
 		self.async_func = None
+		# The done callback is also invoked for a future cancelled by the pool shutdown,
+		# which delivers the cancelled item back to the executor to be unwound.
 		self.future.add_done_callback(self.async_completion_callback)
 		return
 
@@ -260,14 +446,31 @@ class async_workitem(dependency_node):
 		self.async_func = func
 		self.async_args = args
 		self.async_kwargs = kwargs
+		self.async_inline = False
 		return
 
+	# The function is called synchronously when the item gets unblocked
+	def set_inline_func(self, func, *args, **kwargs):
+		self.set_async_func(func, *args, **kwargs)
+		self.async_inline = True
+		return
+
+	def on_cancel(self):
+		# A cancelled item doesn't go through unblocked(),
+		# drop the function arguments, which can hold file data
+		self.async_func = None
+		self.async_args = ()
+		self.async_kwargs = {}
+		return super().on_cancel()
+
 	def result(self):
 		future = self.future
-		if future:
-			self.future = None
-			self.future_result = future.result()
-		return self.future_result
+		if future is None:
+			return self.future_result
+		result = future.result()
+		self.future = None
+		self.future_result = result
+		return result
 
 	def __str__(self):
 		return self.result()
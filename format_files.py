@@ -19,6 +19,7 @@ from typing import Generator
 import sys
 import io, os
 from types import SimpleNamespace
+from itertools import chain, repeat
 # Indent detection
 
 from pathlib import Path
@@ -120,46 +121,46 @@ TOKEN___TRY=b'__try'
 TOKEN___EXCEPT=b'__except'
 TOKEN___FINALLY=b'__finally'
 
-# These constants are used by their unique IDs. The strings help in debugging
-PARSING_STATE_INITIAL_DEFAULT = "initial"
-PARSING_STATE_INITIAL_STATEMENT = "statement"
-PARSING_STATE_EXPRESSION = 'expression'
-PARSING_STATE_EXPRESSION_OR_TYPE = 'expr or type'
-PARSING_STATE_DECLARATION = STORAGE_CLASS_TOKEN
-PARSING_STATE_STRUCT_DECLARATION = STRUCT_TOKEN
-PARSING_STATE_ENUM_DECLARATION=ENUM_TOKEN
-PARSING_STATE_FUNCTION="function()"
-PARSING_STATE_POST_ARGUMENTS=   "alphanum()"
-PARSING_STATE_MEMBERS_INIT_LIST="T::T() :"
-
-PARSING_STATE_ASSIGNMENT = ASSIGNMENT_OP
-PARSING_STATE_ARGUMENTS = 'arguments'
-PARSING_STATE_ASM = ASM_TOKEN
-PARSING_STATE_ASM_STATEMENT = 'asm ;'
-PARSING_STATE_INITIAL_ASM_BLOCK = 'asm {}'
-PARSING_STATE_LABEL = COLON
-PARSING_STATE_NAMESPACE = NAMESPACE_TOKEN
-PARSING_STATE_TEMPLATE = TEMPLATE_TOKEN
-PARSING_STATE_TEMPLATE_ARGS = 'template args'
-PARSING_STATE_SWITCH = SWITCH_TOKEN
-PARSING_STATE_POST_SWITCH = "switch() "
-PARSING_STATE_INITIAL_STATE_SWITCH_BODY = "switch() {}"
-PARSING_STATE_POST_CASE = "case :"
-PARSING_STATE_DEFAULT_LABEL = DEFAULT_TOKEN
-PARSING_STATE_IF = IF_TOKEN
-PARSING_STATE_ELSE = ELSE_TOKEN
-PARSING_STATE_FOR = FOR_TOKEN
-PARSING_STATE_WHILE = WHILE_TOKEN
-PARSING_STATE_PENDING_WHILE = "pending_while"
-PARSING_STATE_DO_WHILE = "do_while"
-PARSING_STATE_TRY = TRY_TOKEN
-PARSING_STATE_CATCH = CATCH_TOKEN
-PARSING_STATE_POST_TRY = "try {}"
-PARSING_STATE___TRY = TOKEN___TRY
-PARSING_STATE_POST___TRY = "__try {}"
-PARSING_STATE___EXCEPT = TOKEN___EXCEPT
-PARSING_STATE_POST___EXCEPT = "__except()"
-PARSING_STATE___FINALLY = TOKEN___FINALLY
+# Parsing states are small consecutive integers, used to index c_parser_state.parsing_handlers
+PARSING_STATE_INITIAL_DEFAULT = 0
+PARSING_STATE_INITIAL_STATEMENT = 1
+PARSING_STATE_EXPRESSION = 2
+PARSING_STATE_EXPRESSION_OR_TYPE = 3
+PARSING_STATE_DECLARATION = 4
+PARSING_STATE_STRUCT_DECLARATION = 5
+PARSING_STATE_ENUM_DECLARATION = 6
+PARSING_STATE_FUNCTION = 7
+PARSING_STATE_POST_ARGUMENTS = 8
+PARSING_STATE_MEMBERS_INIT_LIST = 9
+PARSING_STATE_ASSIGNMENT = 10
+PARSING_STATE_ARGUMENTS = 11
+PARSING_STATE_ASM = 12
+PARSING_STATE_ASM_STATEMENT = 13
+PARSING_STATE_INITIAL_ASM_BLOCK = 14
+PARSING_STATE_LABEL = 15
+PARSING_STATE_NAMESPACE = 16
+PARSING_STATE_TEMPLATE = 17
+PARSING_STATE_TEMPLATE_ARGS = 18
+PARSING_STATE_SWITCH = 19
+PARSING_STATE_POST_SWITCH = 20
+PARSING_STATE_INITIAL_STATE_SWITCH_BODY = 21
+PARSING_STATE_POST_CASE = 22
+PARSING_STATE_DEFAULT_LABEL = 23
+PARSING_STATE_IF = 24
+PARSING_STATE_ELSE = 25
+PARSING_STATE_FOR = 26
+PARSING_STATE_WHILE = 27
+PARSING_STATE_PENDING_WHILE = 28
+PARSING_STATE_DO_WHILE = 29
+PARSING_STATE_TRY = 30
+PARSING_STATE_CATCH = 31
+PARSING_STATE_POST_TRY = 32
+PARSING_STATE___TRY = 33
+PARSING_STATE_POST___TRY = 34
+PARSING_STATE___EXCEPT = 35
+PARSING_STATE_POST___EXCEPT = 36
+PARSING_STATE___FINALLY = 37
+PARSING_STATE_COUNT = 38
 
 ALPHANUM_TOKEN="alphanumeric"
 PREPROCESSOR_LINE=b'#'
@@ -184,20 +185,60 @@ UNDERSCORE=ord(b'_')
 DOLLAR_SIGN=ord(b'$')
 AT_SIGN=ord(b'@')
 
-def is_alphanumeric(c):
-	if type(c) is not int:
-		return False
-	return (c >= UPPERCASE_A and c <= UPPERCASE_Z) \
-		or (c >= LOWERCASE_a and c <= LOWERCASE_z) \
-		or (c >= NUMBER_0 and c <= NUMBER_9) \
-		or c == UNDERSCORE \
-		or c == DOLLAR_SIGN \
+# Non-zero for bytes which can make an identifier
+alphanumeric_table = bytes((c >= UPPERCASE_A and c <= UPPERCASE_Z)
+		or (c >= LOWERCASE_a and c <= LOWERCASE_z)
+		or (c >= NUMBER_0 and c <= NUMBER_9)
+		or c == UNDERSCORE
+		or c == DOLLAR_SIGN
 		or c == AT_SIGN
+		for c in range(256))
+
+# Character classes for tokenize_c_line dispatch
+CHAR_CLASS_OTHER = 0
+CHAR_CLASS_WHITESPACE = 1
+CHAR_CLASS_ALPHANUMERIC = 2
+CHAR_CLASS_QUOTE = 3
+CHAR_CLASS_SLASH = 4
+
+def make_char_class_table():
+	table = bytearray(CHAR_CLASS_OTHER for c in range(256))
+	for c in range(256):
+		if alphanumeric_table[c]:
+			table[c] = CHAR_CLASS_ALPHANUMERIC
+	table[SPACE] = CHAR_CLASS_WHITESPACE
+	table[TAB] = CHAR_CLASS_WHITESPACE
+	table[DOUBLE_QUOTE] = CHAR_CLASS_QUOTE
+	table[SINGLE_QUOTE] = CHAR_CLASS_QUOTE
+	table[SLASH] = CHAR_CLASS_SLASH
+	return bytes(table)
+
+char_class_table = make_char_class_table()
+
+# Matches a run of bytes which can make an identifier
+alphanumeric_run_pattern = re.compile(b'[' +
+	re.escape(bytes(c for c in range(256) if alphanumeric_table[c])) + b']*')
 
 def format_err_handler(s):
 	raise BaseException(s)
 
 class parse_line:
+	__slots__ = (
+		'line',
+		'line_num',
+		'tab_width',
+		'tabs',
+		'trim_trailing_whitespace',
+		'eol',
+		'whitespaces',
+		'non_ws_line',
+		'tail',
+		'num_tabs',
+		'num_spaces',
+		'whitespace_width',
+		'indent',
+		)
+
 	def __init__(self, line, config):
 		self.whitespace_width = 0
 		self.line = line
@@ -205,66 +246,125 @@ class parse_line:
 		self.tabs = config.tabs
 		self.trim_trailing_whitespace = config.trim_trailing_whitespace
 		# Split the line to initial whitespace,
-		# non-whitespace, optional '\\' OR trailing whitespace, and EOL:
-		m = re.fullmatch(rb'([\t ]*)(.*?)((?<!\\)[\t ]*|\\?)(\r?\n?)', line)
-		# Note that trailing whitespace following a backslash is not considered whitespace which can be trimmed
-		if not m:
-			self.whitespaces = b''
-			self.non_ws_line = line
-			self.tail = b''
+		# non-whitespace, optional '\\' OR trailing whitespace, and EOL.
+		# This is the same split as
+		# re.fullmatch(rb'([\t ]*)(.*?)((?<!\\)[\t ]*|\\?)(\r?\n?)', line)
+		# done with bytes methods
+		# EOL is assigned from constants, not sliced from the line,
+		# so that all lines share the same few EOL objects
+		if line.endswith(b'\n'):
+			if line.endswith(b'\r\n'):
+				self.eol = b'\r\n'
+				content = line[:-2]
+			else:
+				self.eol = b'\n'
+				content = line[:-1]
+		elif line.endswith(b'\r'):
+			self.eol = b'\r'
+			content = line[:-1]
+		else:
 			self.eol = b''
-			self.num_tabs = 0
-			self.num_spaces = 0
-			self.indent = 0
-			return
+			content = line
+		end = len(content)
 
-		self.whitespaces, self.non_ws_line, self.tail, self.eol = m.groups(default=b'')
-
-		if not self.non_ws_line:
-			self.tail = self.whitespaces + self.tail
+		line_start = end - len(content.lstrip(b'\t '))
+		# Note that trailing whitespace following a backslash is not considered whitespace which can be trimmed
+		if line_start == end:
+			# Whitespace-only line
 			self.whitespaces = b''
+			self.non_ws_line = b''
+			self.tail = content
+		else:
+			line_end = len(content.rstrip(b'\t '))
+			if line_end < end:
+				if line[line_end-1] == BACKSLASH:
+					# The first whitespace after a backslash stays with the line
+					line_end += 1
+			elif line[end-1] == BACKSLASH:
+				line_end = end - 1
+
+			if line_end > line_start:
+				self.whitespaces = content[:line_start]
+				self.non_ws_line = content[line_start:line_end]
+				self.tail = content[line_end:]
+			else:
+				# Only whitespaces and a backslash
+				self.whitespaces = b''
+				self.non_ws_line = b''
+				self.tail = content
+
+		self.indent = LINE_INDENT_KEEP_CURRENT
 
 		# process spaces and tabs in whitespaces:
 		# first tabs, then spaces are counted. Line with mixed spaces is ignored for indent analysis
-		m = re.match(b'(\t*)( *)(\t)?', self.whitespaces)
-
-		if m and not m[3]:
-			self.num_tabs = len(m[1])
-			self.num_spaces = len(m[2])
-		else:
-			# else Mixed tabs, ignore
+		whitespaces = self.whitespaces
+		if not whitespaces:
+			# A line without indent, or a whitespace-only line
 			self.num_tabs = 0
 			self.num_spaces = 0
+			return
 
-		for c in self.whitespaces:
-			if c == SPACE:
-				self.whitespace_width += 1
-			elif c == TAB:
-				self.whitespace_width = self.whitespace_width + self.tab_width - self.whitespace_width % self.tab_width
-		self.indent = LINE_INDENT_KEEP_CURRENT
+		first_space = whitespaces.find(b' ')
+		if first_space == -1:
+			self.num_tabs = len(whitespaces)
+			self.num_spaces = 0
+			self.whitespace_width = len(whitespaces) * self.tab_width
+			return
+
+		if whitespaces.find(b'\t', first_space) == -1:
+			# Tabs, if any, are followed by spaces
+			self.num_tabs = first_space
+			self.num_spaces = len(whitespaces) - first_space
+			self.whitespace_width = first_space * self.tab_width + self.num_spaces
+			return
+
+		# else Mixed tabs, ignore
+		self.num_tabs = 0
+		self.num_spaces = 0
+
+		# Each run of spaces before a tab is absorbed by the tab, unless it reaches the tab stop
+		whitespace_width = 0
+		for spaces in whitespaces.split(b'\t')[:-1]:
+			whitespace_width += len(spaces) + self.tab_width
+			whitespace_width -= whitespace_width % self.tab_width
+			continue
+		self.whitespace_width = whitespace_width + len(whitespaces) - whitespaces.rfind(b'\t') - 1
 		return
 
 	def make_line(self, line_indent=LINE_INDENT_KEEP_CURRENT_NO_RETAB):
 
-		if line_indent == LINE_INDENT_KEEP_CURRENT:
-			line_indent = self.whitespace_width
+		tail = self.tail
+		if tail and self.trim_trailing_whitespace and not tail.endswith(b'\\'):
+			tail = b''
 
 		if line_indent == LINE_INDENT_KEEP_CURRENT_NO_RETAB:
 			whitespaces = self.whitespaces
-		elif self.tabs:
-			whitespaces = b'\t' * (line_indent // self.tab_width) + b' ' * (line_indent % self.tab_width)
 		else:
-			whitespaces = b' ' * line_indent
+			if line_indent == LINE_INDENT_KEEP_CURRENT:
+				line_indent = self.whitespace_width
 
-		line = whitespaces + self.non_ws_line
+			if self.tabs:
+				whitespaces = b'\t' * (line_indent // self.tab_width) + b' ' * (line_indent % self.tab_width)
+			else:
+				whitespaces = b' ' * line_indent
 
-		if not self.trim_trailing_whitespace or self.tail.endswith(b'\\'):
-			line += self.tail
+		# The parts can only get shorter when they're modified.
+		# If the indent is the same and the length still adds up, the original line can be returned
+		if tail is self.tail and whitespaces == self.whitespaces and len(self.line) == \
+				len(whitespaces) + len(self.non_ws_line) + len(tail) + len(self.eol):
+			return self.line
 
-		line += self.eol
-		return line
+		return b''.join((whitespaces, self.non_ws_line, tail, self.eol))
 
 class parse_partial_lines:
+	__slots__ = (
+		'config',
+		'tab_size',
+		'lines',
+		'line_num',
+		'contains_stray_cr',
+		)
+
 	def __init__(self, config):
 		self.config = config
 		self.tab_size = config.tab_size
@@ -281,9 +381,9 @@ class parse_partial_lines:
 		while (line := next(lines_iter, None)) is not None:
 			p = parse_line(line, self.config)
 			p.line_num = line_num
-			if p.non_ws_line:
-				if CR in p.non_ws_line:
-					self.contains_stray_cr = line_num
+			# A CR can only be a part of non-whitespace line
+			if CR in p.non_ws_line:
+				self.contains_stray_cr = line_num
 
 			self.lines.append(p)
 			if not p.tail.endswith(b'\\'):
@@ -297,7 +397,30 @@ class parse_partial_lines:
 
 		return self.lines
 
-	def __iter__(self):
+	# Returns the characters of the partial lines as three lists:
+	# characters, lines (passed with their first character), and character positions.
+	# A space is inserted before the leading whitespace of a continuation line,
+	# BACKSLASH_SEPARATOR for each trailing backslash, and EOL in the end.
+	# The fourth item is the same characters as bytes, for scanning them with regular expressions.
+	# BACKSLASH_SEPARATOR is a backslash and EOL is a newline there
+	def get_chars(self):
+		if len(self.lines) == 1:
+			line = self.lines[0]
+			non_ws_line = line.non_ws_line
+			if TAB not in non_ws_line and not line.tail.endswith(b'\\'):
+				# The most common case: a single line without tabs after the indent
+				chars = list(non_ws_line)
+				chars.append(EOL)
+				char_lines = [line]
+				char_lines += repeat(None, len(non_ws_line))
+				char_positions = list(range(len(non_ws_line)))
+				char_positions.append(None)
+				return chars, char_lines, char_positions, non_ws_line + EOL
+
+		chars = []
+		char_lines = []
+		char_positions = []
+		text = bytearray()
 		this_line = None
 		backslash = False
 
@@ -305,34 +428,52 @@ class parse_partial_lines:
 			this_line = line
 			if backslash and line.whitespace_width:
 				# Make sure not to lose a whitespace between tokens in a split line
-					yield SPACE, this_line, None
-					this_line = None
-
-			character_pos = 0
-			for c in line.non_ws_line:
+				chars.append(SPACE)
+				text.append(SPACE)
+				char_lines.append(this_line)
+				char_positions.append(None)
+				this_line = None
 
-				yield c, this_line, character_pos
+			non_ws_line = line.non_ws_line
+			if non_ws_line:
+				chars += non_ws_line
+				text += non_ws_line
+				char_lines.append(this_line)
+				char_lines += repeat(None, len(non_ws_line) - 1)
 				this_line = None
-				if c != TAB:
-					character_pos += 1
+				if TAB not in non_ws_line:
+					char_positions += range(len(non_ws_line))
 				else:
-					character_pos += self.tab_size
-					character_pos -= character_pos % self.tab_size
-				continue
+					character_pos = 0
+					for c in non_ws_line:
+						char_positions.append(character_pos)
+						if c != TAB:
+							character_pos += 1
+						else:
+							character_pos += self.tab_size
+							character_pos -= character_pos % self.tab_size
+						continue
 
 			backslash = line.tail.endswith(b'\\')
 			if backslash:
-				yield BACKSLASH_SEPARATOR, this_line, None
+				chars.append(BACKSLASH_SEPARATOR)
+				text.append(BACKSLASH)
+				char_lines.append(this_line)
+				char_positions.append(None)
 				this_line = None
 			continue
 
-		yield EOL, this_line, None
-		return
+		chars.append(EOL)
+		text += EOL
+		char_lines.append(this_line)
+		char_positions.append(None)
+		return chars, char_lines, char_positions, bytes(text)
 
 def read_partial_lines(fd, config)->Generator[parse_partial_lines]:
 	line_num = 1
 
-	lines_iter = read_and_fix_lines(fd, config)
+	# Lines are taken from the blocks without a generator step per line
+	lines_iter = chain.from_iterable(read_and_fix_line_blocks(fd, config))
 	partial_lines = parse_partial_lines(config)
 
 	while (lines := partial_lines.read(lines_iter)):
@@ -344,10 +485,13 @@ def read_partial_lines(fd, config)->Generator[parse_partial_lines]:
 
 	return
 
-def write_partial_lines(lines):
+# Formatted lines are returned in blocks of about this many bytes
+WRITE_BLOCK_SIZE = 0x10000
+
+def write_partial_lines(lines, buffer:bytearray):
 	# compose each of self.lines_to_write
 	for line in lines:
-		yield line.make_line(line.indent)
+		buffer += line.make_line(line.indent)
 		continue
 	return
 
@@ -433,15 +577,23 @@ alphanum_tokens = {
 	b'_finally' : TOKEN___FINALLY,
 }
 
+# Identifiers repeat a lot; reuse their (ALPHANUM_TOKEN, s) tuples.
+# The cache begins with the keywords, to find any token by a single lookup
+alphanum_token_cache = dict(alphanum_tokens)
+ALPHANUM_TOKEN_CACHE_SIZE = len(alphanum_tokens) + 8192
+
 def decode_alphanumeric_token(s:bytes):
 	# Note that we don't return 's' itself,
 	# but a global constant,
 	# to be able to match it by 'is' operator,
-	token = alphanum_tokens.get(s, None)
+	token = alphanum_token_cache.get(s, None)
 	if token is not None:
 		return token
 
-	return (ALPHANUM_TOKEN, s)
+	token = (ALPHANUM_TOKEN, s)
+	if len(alphanum_token_cache) < ALPHANUM_TOKEN_CACHE_SIZE:
+		alphanum_token_cache[s] = token
+	return token
 
 preprocessor_tokens = {
 	PREPROCESSOR_LINE : PREPROCESSOR_LINE,
@@ -455,17 +607,211 @@ preprocessor_tokens = {
 	ELIF_LINE : ELIF_LINE,
 }
 
+# Preprocessor line tokens which parse_c_file stores as pre_parsing_state.preprocessor_line
+PREPROCESSOR_LINE_TOKENS = frozenset(preprocessor_tokens.values())
+
 def decode_preprocessor_token(s:bytes):
 	# Note that we don't return 's' itself,
 	# but a global constant,
 	return preprocessor_tokens.get(s, s)
 
+# Preprocessor conditionals which c_parser_state.save_state treats specially.
+# All of them are matched by this one compiled pattern, only for '#if' and '#elif' lines.
+# The group name tells which one has matched
+conditional_line_pattern = re.compile(rb'(?P<cplusplus>#if(?:def\s+__cplusplus'
+				rb'|\s+defined(?:\s*\(\s*__cplusplus\s*\)|\s+__cplusplus)))'
+				rb'|(?P<false>#(?:el)?if\s(?:0|\(0\)|FALSE))'
+				rb'|(?P<true>#(?:el)?if\s(?:1|\(1\)|TRUE))')
+
+# An expression stack level, pushed by c_parser_state.push_expression_stack
+class expression_stack_item:
+	__slots__ = (
+		'assignment_open',
+		'expression_open',
+		'statement_continuation',
+		'pop_handler',
+		'parsing_state',
+		'pop_parsing_state',
+		'parens_increment',
+		'indent_increment',
+		'use_token_position',
+		'token_position',
+		'next_token_position',
+		'this_line_indent_pos',
+		'absolute_indent_position',
+		'pop_open_parens',
+		'pop_assignment_open',
+		'pop_expression_open',
+		'pop_statement_continuation',
+		'indent_adjustment',
+		'closing_token_position',
+		)
+
+	def __init__(self, state, pop_handler,
+				parsing_state,
+				pop_parsing_state,
+				absolute_indent_position,	# absolute position for the next line continuation at this expression level
+				indent_adjustment,
+				use_token_position,		# Token position relative to the non-whitespace line begin
+				token_position,
+				next_token_position,
+				assignment_open,
+				expression_open,
+				statement_continuation,
+				parens_increment,
+				indent_increment):
+		self.assignment_open = assignment_open
+		self.expression_open = expression_open
+		self.statement_continuation = statement_continuation
+		self.pop_handler = pop_handler
+		self.parsing_state = parsing_state
+		self.pop_parsing_state = pop_parsing_state
+		self.parens_increment = parens_increment
+		self.indent_increment = indent_increment
+		self.use_token_position = use_token_position
+		self.token_position = token_position
+		self.next_token_position = next_token_position
+		self.this_line_indent_pos = state.this_line_indent_pos	# set to this line indent
+		self.absolute_indent_position = absolute_indent_position
+		self.pop_open_parens = state.open_parens
+		self.pop_assignment_open = state.assignment_open
+		self.pop_expression_open = state.expression_open
+		self.pop_statement_continuation = state.statement_continuation
+		self.indent_adjustment = indent_adjustment
+		self.closing_token_position = None
+		return
+
+# A brace block level, pushed by c_parser_state.push_block
+class block_stack_item:
+	__slots__ = (
+		'composite_statement_stack',
+		'nesting_level',
+		'open_braces',
+		'pop_indent',
+		'initial_parsing_state',
+		'pop_parsing_state',
+		'inline_asm',
+		)
+
+	def __init__(self, state, pop_indent, pop_parsing_state):
+		self.composite_statement_stack = state.composite_statement_stack
+		self.nesting_level = state.nesting_level
+		self.open_braces = state.open_braces
+		self.pop_indent = pop_indent
+		self.initial_parsing_state = state.initial_parsing_state
+		self.pop_parsing_state = pop_parsing_state
+		self.inline_asm = state.inline_asm
+		return
+
+# A copy of c_parser_state fields, saved at a preprocessor conditional.
+# The stacks are saved as tuples, and only made lists again on restore.
+# A saved length alone would not do: before the restore, the parser can pop
+# below it and push other items. The stacks are only as deep as the nesting
+class c_parser_saved_state:
+	__slots__ = (
+		'ignore_nesting_change',
+		'restore_c_state',
+		'parsing_state',
+		'initial_parsing_state',
+		'nesting_level',
+		'open_braces',
+		'open_parens',
+		'statement_open',
+		'statement_continuation',
+		'assignment_open',
+		'expression_open',
+		'expression_stack',
+		'composite_statement_stack',
+		'whitespace_adjustment',
+		'line_width_for_adjustment',
+		'block_stack',
+		)
+
+	def __init__(self, state, ignore_nesting_change, restore_c_state):
+		self.ignore_nesting_change = ignore_nesting_change
+		self.restore_c_state = restore_c_state
+		self.parsing_state = state.parsing_state
+		self.initial_parsing_state = state.initial_parsing_state
+		self.nesting_level = state.nesting_level
+		self.open_braces = state.open_braces
+		self.open_parens = state.open_parens
+		self.statement_open = state.statement_open
+		self.statement_continuation = state.statement_continuation
+		self.assignment_open = state.assignment_open
+		self.expression_open = state.expression_open
+		self.expression_stack = tuple(state.expression_stack)
+		self.composite_statement_stack = tuple(state.composite_statement_stack)
+		self.whitespace_adjustment = state.whitespace_adjustment
+		self.line_width_for_adjustment = state.line_width_for_adjustment
+		self.block_stack = tuple(state.block_stack)
+		return
+
+# 'struct', cv-qualifier and type name tokens, consumed as a part of a declaration
+TYPE_TOKENS = frozenset((STRUCT_TOKEN, CV_TOKEN, TYPE_TOKEN))
+
+# Tokens which parse_expression consumes without any state change
+EXPRESSION_PASSTHROUGH_TOKENS = frozenset((DOT, COLONCOLON, OPERATOR, CV_TOKEN))
+
+# c_parser_state.adjust_position_to_tab for space indents
+def keep_position(indent_pos, adjustment=0):
+	return indent_pos
+
 class c_parser_state:
+	__slots__ = (
+		'indent_size',
+		'indent_case',
+		'tab_size',
+		'use_tabs',
+		'tab_alignment',
+		'adjust_position_to_tab',
+		'reindent_continuation',
+		'reindent_continuation_smart',
+		'reindent_continuation_extend',
+		'max_to_parenthesis',
+		'initial_parsing_state',
+		'parsing_state',
+		'parsing_handler',
+		'bound_parsing_handlers',
+		'nesting_level',
+		'open_braces',
+		'open_parens',
+		'statement_open',
+		'statement_continuation',
+		'this_line_indent_pos',
+		'assignment_open',
+		'expression_open',
+		'case_indent',
+		'label_indent',
+		'composite_statement_stack',
+		'composite_statement_token',
+		'block_stack',
+		'expression_stack',
+		'whitespace_adjustment',
+		'line_width_for_adjustment',
+		'inline_asm',
+		'whitespace_width',
+		'first_line_width',
+		'prev_token',
+		'curr_token',
+		'next_token',
+		'subtoken',
+		'token_position',
+		'next_token_position',
+		'replay_token',
+		)
+
 	def __init__(self, config):
 		self.indent_size = config.indent
 		self.indent_case = config.indent_case
 		self.tab_size = config.tab_size
 		self.use_tabs = config.tabs
+		self.tab_alignment = min(self.tab_size, self.indent_size)
+		# The position adjustment is chosen once, the callers don't test use_tabs
+		if self.use_tabs:
+			self.adjust_position_to_tab = self.align_position_to_tab
+		else:
+			# Positions don't need alignment
+			self.adjust_position_to_tab = keep_position
 		self.reindent_continuation = config.reindent_continuation.any
 		self.reindent_continuation_smart = config.reindent_continuation.smart
 		self.reindent_continuation_extend = config.reindent_continuation.extend
@@ -487,6 +833,11 @@ class c_parser_state:
 		self.whitespace_adjustment = 0
 		self.line_width_for_adjustment = self.max_to_parenthesis*2
 		self.inline_asm = False
+		self.replay_token = False
+		# Handlers bound to this instance, indexed by the parsing state
+		self.bound_parsing_handlers = tuple(
+			handler.__get__(self) if handler is not None else None
+				for handler in self.parsing_handlers)
 		self.set_initial_parsing_state()
 		self.expression_stack = []
 		return
@@ -503,65 +854,67 @@ class c_parser_state:
 	# when a preprocessor conditional block begins.
 	def save_state(self, preprocessor_line,
 				prev_ignore_nesting_change=None, prev_restore_c_state=None):
-		# Save a copy of C parser state
+		# Save a copy of C parser state.
+		# A new snapshot is made every time: it holds the stacks as of this line,
+		# and the expression stack items in them are changed by the parser later
 
-		if re.match(b'#else', preprocessor_line):
+		if preprocessor_line.startswith(b'#else'):
 			if prev_restore_c_state == 'all':
 				restore_c_state = prev_restore_c_state
 				ignore_nesting_change = prev_ignore_nesting_change
 			else:
 				restore_c_state = not prev_restore_c_state
 				ignore_nesting_change = not prev_ignore_nesting_change
-		elif re.match(rb'#if(?:def\s+__cplusplus'
-				rb'|\s+defined(?:\s*\(\s*__cplusplus\s*\)|\s+__cplusplus))',
-						preprocessor_line):
-			ignore_nesting_change = True
-			restore_c_state = True
-		elif re.match(rb'#(?:el)?if\s(?:0|\(0\)|FALSE)', preprocessor_line):
-			restore_c_state = True
-			ignore_nesting_change = True
-		elif re.match(rb'#(?:el)?if\s(?:1|\(1\)|TRUE)', preprocessor_line):
-			restore_c_state = False
-			ignore_nesting_change = True
 		else:
-			ignore_nesting_change = False
-			restore_c_state = 'all'
-
-		return SimpleNamespace(
-			ignore_nesting_change = ignore_nesting_change,
-			restore_c_state = restore_c_state,
-			parsing_state = self.parsing_state,
-			initial_parsing_state = self.initial_parsing_state,
-			nesting_level = self.nesting_level,
-			open_braces = self.open_braces,
-			open_parens = self.open_parens,
-			statement_open = self.statement_open,
-			statement_continuation = self.statement_continuation,
-			assignment_open = self.assignment_open,
-			expression_open = self.expression_open,
-			expression_stack = self.expression_stack.copy(),
-			composite_statement_stack = self.composite_statement_stack.copy(),
-			whitespace_adjustment = self.whitespace_adjustment,
-			line_width_for_adjustment = self.line_width_for_adjustment,
-			block_stack = self.block_stack.copy(),
-		)
+			# Only '#if' and '#elif' lines need the pattern match
+			m = None
+			if preprocessor_line.startswith((b'#if', b'#elif')):
+				m = conditional_line_pattern.match(preprocessor_line)
+
+			if m is None:
+				ignore_nesting_change = False
+				restore_c_state = 'all'
+			elif m.lastgroup == 'cplusplus':
+				ignore_nesting_change = True
+				restore_c_state = True
+			elif m.lastgroup == 'false':
+				restore_c_state = True
+				ignore_nesting_change = True
+			else:
+				restore_c_state = False
+				ignore_nesting_change = True
+
+		return c_parser_saved_state(self, ignore_nesting_change, restore_c_state)
 
 	def restore_state(self, save):
 		if not save.restore_c_state:
 			return
-		self.initial_parsing_state = save.initial_parsing_state
-		self.nesting_level = save.nesting_level
-		self.open_braces = save.open_braces
-		self.open_parens = save.open_parens
-		self.statement_open = save.statement_open
-		self.statement_continuation = save.statement_continuation
-		self.expression_open = save.expression_open
-		self.assignment_open = save.assignment_open
-		self.expression_stack = save.expression_stack
-		self.composite_statement_stack = save.composite_statement_stack
-		self.whitespace_adjustment = save.whitespace_adjustment
-		self.line_width_for_adjustment = save.line_width_for_adjustment
-		self.block_stack = save.block_stack
+		(self.initial_parsing_state,
+			self.nesting_level,
+			self.open_braces,
+			self.open_parens,
+			self.statement_open,
+			self.statement_continuation,
+			self.expression_open,
+			self.assignment_open,
+			self.expression_stack,
+			self.composite_statement_stack,
+			self.whitespace_adjustment,
+			self.line_width_for_adjustment,
+			self.block_stack) = (
+				save.initial_parsing_state,
+				save.nesting_level,
+				save.open_braces,
+				save.open_parens,
+				save.statement_open,
+				save.statement_continuation,
+				save.expression_open,
+				save.assignment_open,
+				list(save.expression_stack),
+				list(save.composite_statement_stack),
+				save.whitespace_adjustment,
+				save.line_width_for_adjustment,
+				list(save.block_stack))
 		self.set_parsing_state(save.parsing_state)
 		return
 
@@ -578,7 +931,8 @@ class c_parser_state:
 		self.expression_open = False
 		self.statement_continuation = False
 		self.open_parens = 0
-		self.expression_stack = []
+		# Saved states keep their own copies, the list can be reused
+		self.expression_stack.clear()
 		self.whitespace_adjustment = 0
 		self.line_width_for_adjustment = self.max_to_parenthesis*2
 		self.pop_composite_statement()
@@ -603,26 +957,15 @@ class c_parser_state:
 										open_expression=expression_open)
 			self.set_line_indent()
 
-		stack_item = SimpleNamespace()
-		stack_item.assignment_open = assignment_open
-		stack_item.expression_open = expression_open
-		stack_item.pop_handler = pop_handler
+		item_parsing_state = parsing_state
+		if item_parsing_state is None:
+			item_parsing_state = self.parsing_state
 
-		if parsing_state is not None:
-			stack_item.parsing_state = parsing_state
-		else:
-			stack_item.parsing_state = self.parsing_state
+		if pop_parsing_state is None:
+			pop_parsing_state = self.parsing_state
 
-		if pop_parsing_state is not None:
-			stack_item.pop_parsing_state = pop_parsing_state
-		else:
-			stack_item.pop_parsing_state = self.parsing_state
-
-		stack_item.parens_increment = parens_increment
-		if indent_increment is not None:
-			stack_item.indent_increment = indent_increment
-		else:
-			stack_item.indent_increment = parens_increment
+		if indent_increment is None:
+			indent_increment = parens_increment
 
 		token_position = self.token_position + self.this_line_indent_pos
 		next_token_position = self.next_token_position
@@ -634,9 +977,8 @@ class c_parser_state:
 				use_token_position = self.adjust_position_to_tab(next_token_position, 1)
 			else:
 				use_token_position = self.adjust_position_to_tab(token_position+1, 1)
-			stack_item.use_token_position=use_token_position	# Token position relative to the non-whitespace line begin
 		elif self.expression_stack:
-			stack_item.use_token_position = None
+			use_token_position = None
 			stack_top = self.expression_stack[-1]
 			# Inherit this position from the previous expression level
 			# to limit "extend_only" indents.
@@ -646,20 +988,23 @@ class c_parser_state:
 				(stack_top.token_position and
 				(stack_top.token_position + 1)))
 		else:
-			stack_item.use_token_position = None
-
-		stack_item.token_position = token_position
-		stack_item.next_token_position = next_token_position
-		stack_item.this_line_indent_pos = self.this_line_indent_pos			# set to this line indent
-		stack_item.absolute_indent_position = absolute_token_position	# absolute position for the next line continuation at this expression level
-		stack_item.pop_open_parens = self.open_parens
-		stack_item.pop_assignment_open = self.assignment_open
-		stack_item.pop_expression_open = self.expression_open
-		stack_item.pop_statement_continuation = self.statement_continuation
-		stack_item.statement_continuation = statement_continuation
-
-		stack_item.indent_adjustment = indent_adjustment
-		stack_item.closing_token_position = None
+			use_token_position = None
+
+		# Arguments are passed by position, in the order of expression_stack_item.__init__
+		stack_item = expression_stack_item(self,
+						pop_handler,
+						item_parsing_state,
+						pop_parsing_state,
+						absolute_token_position,
+						indent_adjustment,
+						use_token_position,
+						token_position,
+						next_token_position,
+						assignment_open,
+						expression_open,
+						statement_continuation,
+						parens_increment,
+						indent_increment)
 
 		self.expression_stack.append(stack_item)
 
@@ -673,7 +1018,7 @@ class c_parser_state:
 
 	def pop_expression_stack(self, token):
 		while self.expression_stack:
-			stack_item = self.expression_stack.pop(-1)
+			stack_item = self.expression_stack.pop()
 			self.open_parens = stack_item.pop_open_parens
 			self.assignment_open = stack_item.pop_assignment_open
 			self.expression_open = stack_item.pop_expression_open
@@ -766,11 +1111,10 @@ class c_parser_state:
 		stack_loc.absolute_indent_position = indent_pos
 		return indent_pos
 
-	def adjust_position_to_tab(self, indent_pos, adjustment=0):
-		if not self.use_tabs:
-			return indent_pos
+	# Used as adjust_position_to_tab for an instance which uses tabs
+	def align_position_to_tab(self, indent_pos, adjustment=0):
 		indent_pos += adjustment
-		return indent_pos - indent_pos % min(self.tab_size, self.indent_size)
+		return indent_pos - indent_pos % self.tab_alignment
 
 	def adjust_expression_state(self,
 					open_expression=None,
@@ -901,15 +1245,7 @@ class c_parser_state:
 				pop_parsing_state=None):
 		pop_indent = self.nesting_level - 1 + indent_adjustment
 
-		self.block_stack.append(SimpleNamespace(
-			composite_statement_stack=self.composite_statement_stack,
-			nesting_level=self.nesting_level,
-			open_braces=self.open_braces,
-			pop_indent=pop_indent,
-			initial_parsing_state=self.initial_parsing_state,
-			pop_parsing_state=pop_parsing_state,
-			inline_asm=self.inline_asm,
-			))
+		self.block_stack.append(block_stack_item(self, pop_indent, pop_parsing_state))
 
 		self.composite_statement_token = None
 		self.composite_statement_stack = []
@@ -956,6 +1292,8 @@ class c_parser_state:
 		if increment_nesting is None:
 			increment_nesting = self.next_token is not DO_TOKEN
 		self.set_line_indent(indent)
+		# One tuple per level: it's unpacked in one step by pop_composite_statement,
+		# and the whole stack is copied as one list by save_state and push_block
 		composite_statement_state = (
 			pop_state,
 			self.initial_parsing_state,
@@ -1017,7 +1355,8 @@ class c_parser_state:
 			return True
 
 		if token is COLON:
-			self.set_parsing_state(PARSING_STATE_DECLARATION)
+			self.parsing_state = PARSING_STATE_DECLARATION
+			self.parsing_handler = self.bound_parsing_handlers[PARSING_STATE_DECLARATION]
 			if self.statement_open:
 				self.statement_continuation = True
 			self.statement_open = True
@@ -1191,14 +1530,15 @@ class c_parser_state:
 	def process_pending_else_token(self, token):
 		if token is not ELSE_TOKEN:
 			# Expected possible 'else' clause, but it didn't come.
-			# Pop all nested 'if' statements pending else,
-			while 1:
-				parse_state = self.pop_composite_statement()
-				if parse_state is not PARSING_STATE_ELSE:
-					break
+			# Pop all nested 'if' statements pending else
+			# at once, instead of re-entering this handler for each of them.
+			self.pop_composite_statement()
+			while self.parsing_state is PARSING_STATE_ELSE:
+				self.pop_composite_statement()
 				continue
 
-			return self.parse_token(self.curr_token)
+			self.replay_token = True
+			return False
 
 		# begin a composite statement
 		# No additional block indent if another composite statement
@@ -1242,105 +1582,134 @@ class c_parser_state:
 		self.set_parsing_state(parsing_state)
 		return True
 
-	def process_opening_token(self, token):
-		if token is IF_TOKEN:
-			# Now the next token must be a parenthesis
-			return self.open_composite_statement(PARSING_STATE_IF)
-
-		if token is ELSE_TOKEN:
-			# out of place 'else'
-			return self.process_pending_else_token(token)
-
-		if token is FOR_TOKEN:
-			return self.open_composite_statement(PARSING_STATE_FOR)
-
-		if token is WHILE_TOKEN:
-			return self.open_composite_statement(PARSING_STATE_WHILE)
-
-		if token is SWITCH_TOKEN:
-			return self.open_composite_statement(PARSING_STATE_SWITCH)
-
-		if token is DO_TOKEN:
-			self.push_composite_statement(PARSING_STATE_PENDING_WHILE)
-			return True
+	def process_composite_token(self, token):
+		# For 'if', 'for', 'while', 'switch' the next token must be a parenthesis
+		return self.open_composite_statement(self.composite_token_states[token])
 
-		if token is GOTO_TOKEN:
-			self.open_statement()
-			return True
+	def process_do_token(self, token):
+		self.push_composite_statement(PARSING_STATE_PENDING_WHILE)
+		return True
 
-		if token is RETURN_TOKEN:
-			self.open_statement()
-			if self.next_token is not None:
-				self.push_expression_stack(None, expression_open=False,
-						parens_increment=0,
-						indent_increment=1,
-						use_token_position=self.next_token is not PAREN_OPEN)
-			self.statement_continuation = True
-			return True
+	def process_goto_token(self, token):
+		self.open_statement()
+		return True
 
-		if token is NAMESPACE_TOKEN:
-			return self.open_composite_statement(PARSING_STATE_NAMESPACE)
+	def process_return_token(self, token):
+		self.open_statement()
+		if self.next_token is not None:
+			self.push_expression_stack(None, expression_open=False,
+					parens_increment=0,
+					indent_increment=1,
+					use_token_position=self.next_token is not PAREN_OPEN)
+		self.statement_continuation = True
+		return True
 
-		if token is TRY_TOKEN:
-			indent = 0-bool(self.composite_statement_stack)
-			self.push_composite_statement(indent=indent,
-							increment_nesting=indent)
-			self.push_composite_statement(PARSING_STATE_POST_TRY, increment_nesting=0)
-			self.set_parsing_state(PARSING_STATE_TRY)
-			return True
+	def process_try_token(self, token):
+		indent = 0-bool(self.composite_statement_stack)
+		self.push_composite_statement(indent=indent,
+						increment_nesting=indent)
+		self.push_composite_statement(PARSING_STATE_POST_TRY, increment_nesting=0)
+		self.set_parsing_state(PARSING_STATE_TRY)
+		return True
 
-		if token is TOKEN___TRY:
-			indent = 0-bool(self.composite_statement_stack)
-			self.push_composite_statement(indent=indent,
-							increment_nesting=indent)
-			self.push_composite_statement(PARSING_STATE_POST___TRY, increment_nesting=0)
-			self.set_parsing_state(PARSING_STATE___TRY)
-			return True
+	def process___try_token(self, token):
+		indent = 0-bool(self.composite_statement_stack)
+		self.push_composite_statement(indent=indent,
+						increment_nesting=indent)
+		self.push_composite_statement(PARSING_STATE_POST___TRY, increment_nesting=0)
+		self.set_parsing_state(PARSING_STATE___TRY)
+		return True
 
-		if token is TEMPLATE_TOKEN:
-			return self.open_composite_statement(PARSING_STATE_TEMPLATE)
+	def process_declaration_token(self, token):
+		self.parsing_state = PARSING_STATE_DECLARATION
+		self.parsing_handler = self.bound_parsing_handlers[PARSING_STATE_DECLARATION]
+		self.set_line_indent(0)
+		self.statement_open = True
+		return True
 
-		if token is ENUM_TOKEN:
-			return self.open_composite_statement(PARSING_STATE_ENUM_DECLARATION)
+	def process_asm_token(self, token):
+		self.push_composite_statement()
+		self.inline_asm = True
+		self.set_parsing_state(PARSING_STATE_ASM_STATEMENT)
+		return True
 
-		if token is STRUCT_TOKEN or token is CV_TOKEN or token is STORAGE_CLASS_TOKEN or token is TYPE_TOKEN:
-			self.set_parsing_state(PARSING_STATE_DECLARATION)
-			self.set_line_indent(0)
-			self.statement_open = True
-			return True
+	composite_token_states = {
+		IF_TOKEN : PARSING_STATE_IF,
+		FOR_TOKEN : PARSING_STATE_FOR,
+		WHILE_TOKEN : PARSING_STATE_WHILE,
+		SWITCH_TOKEN : PARSING_STATE_SWITCH,
+		NAMESPACE_TOKEN : PARSING_STATE_NAMESPACE,
+		TEMPLATE_TOKEN : PARSING_STATE_TEMPLATE,
+		ENUM_TOKEN : PARSING_STATE_ENUM_DECLARATION,
+		}
 
-		if token is ASM_TOKEN:
-			self.push_composite_statement()
-			self.inline_asm = True
-			self.set_parsing_state(PARSING_STATE_ASM_STATEMENT)
-			return True
+	# Handlers for the tokens which can begin a statement,
+	# looked up by the token instead of testing them one by one
+	opening_token_handlers = {
+		IF_TOKEN : process_composite_token,
+		# out of place 'else'
+		ELSE_TOKEN : process_pending_else_token,
+		FOR_TOKEN : process_composite_token,
+		WHILE_TOKEN : process_composite_token,
+		SWITCH_TOKEN : process_composite_token,
+		DO_TOKEN : process_do_token,
+		GOTO_TOKEN : process_goto_token,
+		RETURN_TOKEN : process_return_token,
+		NAMESPACE_TOKEN : process_composite_token,
+		TRY_TOKEN : process_try_token,
+		TOKEN___TRY : process___try_token,
+		TEMPLATE_TOKEN : process_composite_token,
+		ENUM_TOKEN : process_composite_token,
+		STRUCT_TOKEN : process_declaration_token,
+		CV_TOKEN : process_declaration_token,
+		STORAGE_CLASS_TOKEN : process_declaration_token,
+		TYPE_TOKEN : process_declaration_token,
+		ASM_TOKEN : process_asm_token,
+		}
 
-		return False
+	def process_opening_token(self, token):
+		handler = self.opening_token_handlers.get(token)
+		if handler is None:
+			return False
+		return handler(self, token)
 
 	def process_token(self, token):
+		# Identifiers and operators come as (token, subtoken) tuples, other tokens bare.
+		# Don't make all tokens pairs: next_token keeps the tuple form, and lookahead
+		# tests like 'next_token is ALPHANUM_TOKEN' depend on not matching it
 		if type(token) is tuple:
 			token, self.subtoken = token
 		else:
 			self.subtoken = None
 
 		self.curr_token = token
-		self.parse_token(token)
-		if self.prev_token is None and self.curr_token is not None:
+		# Only process_token and init_new_line change prev_token
+		prev_token = self.prev_token
+		while 1:
+			statement_open = self.statement_open is not None \
+				or self.parsing_state is not self.initial_parsing_state
+			if self.parsing_handler(token):
+				if not (statement_open
+					or self.statement_open is not None
+					or self.parsing_state is not self.initial_parsing_state):
+					self.open_statement()
+				break
+			if not self.replay_token:
+				self.last_resort_handler(token)
+				break
+			# The handler changed the parsing state
+			# and asked for the token to be processed again
+			self.replay_token = False
+			token = self.curr_token
+			continue
+
+		# The handler may have replaced the current token
+		token = self.curr_token
+		if prev_token is None and token is not None:
 			self.set_line_indent()
-		self.prev_token = self.curr_token
+		self.prev_token = token
 		return
 
-	def parse_token(self, token):
-		statement_open = self.statement_open is not None \
-			or self.parsing_state is not self.initial_parsing_state
-		if not self.parsing_handler(self, token):
-			self.last_resort_handler(token)
-		elif not (statement_open
-			or self.statement_open is not None
-			or self.parsing_state is not self.initial_parsing_state):
-			self.open_statement()
-		return True
-
 	def parse_closing_token(self, token):
 
 		if token is BRACE_OPEN:
@@ -1382,7 +1751,7 @@ class c_parser_state:
 		return True
 
 	def parse_template_args(self, token):
-		if token is STRUCT_TOKEN or token is CV_TOKEN or token is TYPE_TOKEN:
+		if token in TYPE_TOKENS:
 			return True
 		if token is ASSIGNMENT_OP and self.subtoken is EQUAL:
 			self.push_expression_stack(None,
@@ -1396,18 +1765,31 @@ class c_parser_state:
 
 		if token is not OP:
 			return self.parse_expression_or_type(token)
-		if self.subtoken is GREATER:
-			self.pop_expression_stack(GREATER)
-			return True
-		elif self.subtoken is RIGHT_SHIFT:
-			self.pop_expression_stack(GREATER)
-			self.pop_expression_stack(GREATER)
-			return True
-		if self.subtoken is LESS:
-			self.push_expression_stack(self.template_args_closed,
-								parsing_state=PARSING_STATE_TEMPLATE_ARGS)
-			return True
-		return False
+		handler = self.template_args_operator_handlers.get(self.subtoken)
+		if handler is None:
+			return False
+		return handler(self)
+
+	def close_template_args(self):
+		self.pop_expression_stack(GREATER)
+		return True
+
+	def close_nested_template_args(self):
+		# '>>' closes two levels of template arguments
+		self.pop_expression_stack(GREATER)
+		self.pop_expression_stack(GREATER)
+		return True
+
+	def open_nested_template_args(self):
+		self.push_expression_stack(self.template_args_closed,
+							parsing_state=PARSING_STATE_TEMPLATE_ARGS)
+		return True
+
+	template_args_operator_handlers = {
+		GREATER : close_template_args,
+		RIGHT_SHIFT : close_nested_template_args,
+		LESS : open_nested_template_args,
+		}
 
 	def parse_template(self, token):
 		self.set_parsing_state(PARSING_STATE_DECLARATION)
@@ -1444,9 +1826,10 @@ class c_parser_state:
 		return True
 
 	def parse_expression_or_type(self, token):
-		if token is CV_TOKEN:
-			return True
-		elif token is STRUCT_TOKEN:
+		# Most tokens here belong to an expression
+		if token not in TYPE_TOKENS:
+			return self.parse_expression(token)
+		if token is STRUCT_TOKEN:
 			if self.next_token is ALPHANUM_TOKEN:
 				self.next_token = TYPE_TOKEN
 		elif token is TYPE_TOKEN:
@@ -1454,21 +1837,24 @@ class c_parser_state:
 				self.curr_token = ALPHANUM_TOKEN
 			elif self.next_token is not TYPE_TOKEN:
 				self.set_parsing_state(PARSING_STATE_EXPRESSION_OR_TYPE)
-		else:
-			return self.parse_expression(token)
 		return True
 
 	def parse_expression(self, token):
 
-		if self.prev_token is OPERATOR \
-			and (token is OP or token is ASSIGNMENT_OP):
-			self.curr_token = ALPHANUM_TOKEN
-			self.open_statement()
-			return True
+		# The most frequent tokens are checked first
 		if token is ALPHANUM_TOKEN or token is QUOTED_LITERAL or token is STRING_LITERAL:
-			# Just consume it
-			self.open_statement()
-		elif token is OP:
+			# Just consume it. Same as open_statement(), expanded:
+			# set_line_indent() only has work to do for the first token in a line
+			if self.prev_token is None:
+				self.set_line_indent()
+			self.statement_open = True
+			return True
+
+		if token is OP:
+			if self.prev_token is OPERATOR:
+				self.curr_token = ALPHANUM_TOKEN
+				self.open_statement()
+				return True
 			if self.expression_stack:
 				return True
 			if self.statement_open:
@@ -1478,7 +1864,7 @@ class c_parser_state:
 			self.set_parsing_state(PARSING_STATE_EXPRESSION)
 			return True
 
-		elif token is PAREN_OPEN:
+		if token is PAREN_OPEN:
 			if self.prev_token is not ALPHANUM_TOKEN:
 				self.set_line_indent()
 
@@ -1510,7 +1896,17 @@ class c_parser_state:
 								use_token_position=True)
 			return True
 
-		elif token is BRACKET_OPEN:
+		if token is COMMA:
+			return self.parse_comma(token)
+
+		if token is PAREN_CLOSE or token is SEMICOLON:
+			# Invoke close expression handler
+			return self.pop_expression_stack(token)
+
+		if token in EXPRESSION_PASSTHROUGH_TOKENS:
+			return True
+
+		if token is BRACKET_OPEN:
 			self.open_statement()
 			self.push_expression_stack(self.parse_bracket_close)
 			return True
@@ -1519,6 +1915,10 @@ class c_parser_state:
 			self.push_expression_stack(self.parse_ternary_colon,
 								pop_parsing_state=PARSING_STATE_EXPRESSION)
 		elif token is ASSIGNMENT_OP:
+			if self.prev_token is OPERATOR:
+				self.curr_token = ALPHANUM_TOKEN
+				self.open_statement()
+				return True
 			self.statement_open = True
 			self.push_expression_stack(None,
 								assignment_open=True,
@@ -1528,16 +1928,6 @@ class c_parser_state:
 									self.next_token is not None
 									and self.next_token is not BRACE_OPEN)
 
-		elif token is COMMA:
-			return self.parse_comma(token)
-		elif token is DOT:
-			pass
-		elif token is COLONCOLON:
-			pass
-		elif token is OPERATOR:
-			pass
-		elif token is CV_TOKEN:
-			pass
 		elif token is STRUCT_TOKEN:
 			if self.next_token is ALPHANUM_TOKEN:
 				self.next_token = TYPE_TOKEN
@@ -1566,23 +1956,23 @@ class c_parser_state:
 
 		self.assignment_open = False
 		self.expression_open = False
-		if self.parsing_state is not PARSING_STATE_DECLARATION \
-			and self.parsing_state is not PARSING_STATE_DECLARATION:
+		if self.parsing_state is not PARSING_STATE_DECLARATION:
 			self.statement_continuation = False
 
 		if not self.expression_stack:
 			self.statement_open = False
 			return True
 
-		while self.expression_stack:
-			expr_state = self.expression_stack[-1]
+		expression_stack = self.expression_stack
+		while expression_stack:
+			expr_state = expression_stack[-1]
 			if expr_state.pop_handler is not None:
 				self.assignment_open = expr_state.assignment_open
 				self.expression_open = expr_state.expression_open
 				self.statement_continuation = expr_state.statement_continuation
 				self.set_parsing_state(expr_state.parsing_state)
 				return True
-			self.expression_stack.pop(-1)
+			expression_stack.pop()
 			continue
 
 		return True
@@ -1675,7 +2065,7 @@ class c_parser_state:
 		if token is OPERATOR:
 			return True
 
-		if token is STRUCT_TOKEN or token is CV_TOKEN or token is TYPE_TOKEN:
+		if token in TYPE_TOKENS:
 			self.set_line_indent(0)
 			return True
 		if self.prev_token is OPERATOR \
@@ -1700,7 +2090,7 @@ class c_parser_state:
 	def parse_post_try(self, token):
 		if token is not CATCH_TOKEN:
 			self.close_statement()
-			return self.parsing_handler(self, self.curr_token)
+			return self.parsing_handler(self.curr_token)
 		self.push_composite_statement(PARSING_STATE_POST_TRY, increment_nesting=0)
 		self.set_parsing_state(PARSING_STATE_CATCH)
 		return True
@@ -1739,7 +2129,7 @@ class c_parser_state:
 			self.set_parsing_state(PARSING_STATE___EXCEPT)
 			return True
 		self.close_statement()
-		return self.parsing_handler(self, self.curr_token)
+		return self.parsing_handler(self.curr_token)
 
 	def parse___except(self, token):
 		if token is not PAREN_OPEN:
@@ -1770,43 +2160,44 @@ class c_parser_state:
 	parse___finally = parse_post___except
 
 	parsing_handlers = {
-		id(PARSING_STATE_INITIAL_DEFAULT) : parse_initial_state,
-		id(PARSING_STATE_EXPRESSION) : parse_expression,
-		id(PARSING_STATE_ASSIGNMENT) : parse_assignment_expression,
-		id(PARSING_STATE_DECLARATION) : parse_declaration,
-		id(PARSING_STATE_EXPRESSION_OR_TYPE) : parse_expression_or_type,
-		id(PARSING_STATE_ENUM_DECLARATION) : parse_enum_declaration,
-		id(PARSING_STATE_FUNCTION) : parse_function,
-		id(PARSING_STATE_POST_ARGUMENTS) : parse_post_arguments,
-		id(PARSING_STATE_MEMBERS_INIT_LIST) : parse_members_init_list,
-		id(PARSING_STATE_ARGUMENTS) : parse_expression,
-		id(PARSING_STATE_LABEL) : parse_label,
-		id(PARSING_STATE_IF) : parse_if,
-		id(PARSING_STATE_ELSE) : process_pending_else_token,
-		id(PARSING_STATE_WHILE) : parse_while,
-		id(PARSING_STATE_FOR) : parse_for,
-		id(PARSING_STATE_SWITCH) : parse_switch,
-		id(PARSING_STATE_POST_SWITCH) : parse_post_switch,
-		id(PARSING_STATE_INITIAL_STATE_SWITCH_BODY) : parse_switch_body,
-		id(PARSING_STATE_POST_CASE) : parse_post_case,
-		id(PARSING_STATE_DEFAULT_LABEL) : parse_default_label,
-		id(PARSING_STATE_PENDING_WHILE) : parse_pending_while,
-		id(PARSING_STATE_DO_WHILE) : parse_do_while,
-		id(PARSING_STATE_TRY) : parse_try,
-		id(PARSING_STATE_CATCH) : parse_catch,
-		id(PARSING_STATE_NAMESPACE) : parse_namespace,
-		id(PARSING_STATE_TEMPLATE) : parse_template,
-		id(PARSING_STATE_TEMPLATE_ARGS) : parse_template_args,
-		id(PARSING_STATE_ASM) : parse_asm,
-		id(PARSING_STATE_ASM_STATEMENT) : parse_asm_line,
-		id(PARSING_STATE_INITIAL_ASM_BLOCK) : parse_asm_block,
-		id(PARSING_STATE_POST_TRY) : parse_post_try,
-		id(PARSING_STATE___TRY) : parse___try,
-		id(PARSING_STATE___FINALLY) : parse___finally,
-		id(PARSING_STATE___EXCEPT) : parse___except,
-		id(PARSING_STATE_POST___TRY) : parse_post___try,
-		id(PARSING_STATE_POST___EXCEPT) : parse_post___except,
+		PARSING_STATE_INITIAL_DEFAULT : parse_initial_state,
+		PARSING_STATE_EXPRESSION : parse_expression,
+		PARSING_STATE_ASSIGNMENT : parse_assignment_expression,
+		PARSING_STATE_DECLARATION : parse_declaration,
+		PARSING_STATE_EXPRESSION_OR_TYPE : parse_expression_or_type,
+		PARSING_STATE_ENUM_DECLARATION : parse_enum_declaration,
+		PARSING_STATE_FUNCTION : parse_function,
+		PARSING_STATE_POST_ARGUMENTS : parse_post_arguments,
+		PARSING_STATE_MEMBERS_INIT_LIST : parse_members_init_list,
+		PARSING_STATE_ARGUMENTS : parse_expression,
+		PARSING_STATE_LABEL : parse_label,
+		PARSING_STATE_IF : parse_if,
+		PARSING_STATE_ELSE : process_pending_else_token,
+		PARSING_STATE_WHILE : parse_while,
+		PARSING_STATE_FOR : parse_for,
+		PARSING_STATE_SWITCH : parse_switch,
+		PARSING_STATE_POST_SWITCH : parse_post_switch,
+		PARSING_STATE_INITIAL_STATE_SWITCH_BODY : parse_switch_body,
+		PARSING_STATE_POST_CASE : parse_post_case,
+		PARSING_STATE_DEFAULT_LABEL : parse_default_label,
+		PARSING_STATE_PENDING_WHILE : parse_pending_while,
+		PARSING_STATE_DO_WHILE : parse_do_while,
+		PARSING_STATE_TRY : parse_try,
+		PARSING_STATE_CATCH : parse_catch,
+		PARSING_STATE_NAMESPACE : parse_namespace,
+		PARSING_STATE_TEMPLATE : parse_template,
+		PARSING_STATE_TEMPLATE_ARGS : parse_template_args,
+		PARSING_STATE_ASM : parse_asm,
+		PARSING_STATE_ASM_STATEMENT : parse_asm_line,
+		PARSING_STATE_INITIAL_ASM_BLOCK : parse_asm_block,
+		PARSING_STATE_POST_TRY : parse_post_try,
+		PARSING_STATE___TRY : parse___try,
+		PARSING_STATE___FINALLY : parse___finally,
+		PARSING_STATE___EXCEPT : parse___except,
+		PARSING_STATE_POST___TRY : parse_post___try,
+		PARSING_STATE_POST___EXCEPT : parse_post___except,
 		}
+	parsing_handlers = tuple(map(parsing_handlers.get, range(PARSING_STATE_COUNT)))
 
 	def set_initial_parsing_state(self):
 		self.statement_open = None
@@ -1814,19 +2205,17 @@ class c_parser_state:
 
 	def set_parsing_state(self, state):
 		self.parsing_state = state
-		self.parsing_handler = self.parsing_handlers[id(state)]
+		self.parsing_handler = self.bound_parsing_handlers[state]
 		return
 
 	def last_resort_handler(self, token):
-		if self.parse_closing_token(token):
-			return True
-
+		# A semicolon is the most frequent token to get here
 		if token is SEMICOLON:
 			self.open_statement()
 			self.close_statement()
 			return True
 
-		return False
+		return self.parse_closing_token(token)
 
 # The dictionary converts a character to a fixed token which can be tested with 'is'
 operator_dict = {
@@ -1907,13 +2296,57 @@ operator_dict = {
 		None: (ASSIGNMENT_OP, EQUAL),
 	},
 }
+
+# First level of operator_dict, flattened to be indexed by the source byte.
+# Bytes which don't start an operator map to themselves
+operator_table = tuple(operator_dict.get(c, c) for c in range(256))
+
+# Finds references to groups in a pattern: backreferences and conditionals
+group_reference_pattern = re.compile(rb'\\[1-9]|\(\?P=|\(\?\(')
+
+# Returns a list with a single alternation of the patterns, to run one match instead of several.
+# Patterns which refer to their groups are returned as is, because group numbers would change.
+# Duplicate group names fail to compile, and are returned as is, too.
+# Patterns with global flags are returned as is, because the flags would apply to all of them
+def combine_match_patterns(patterns):
+	if len(patterns) < 2 or any(pattern.flags or group_reference_pattern.search(pattern.pattern)
+								for pattern in patterns):
+		return patterns
+	try:
+		return [re.compile(b'|'.join(b'(?:' + pattern.pattern + b')' for pattern in patterns))]
+	except re.error:
+		return patterns
+
 class pre_parsing_state:
+	__slots__ = (
+		'log_handler',
+		'format_slashslash_comments',
+		'format_multiline_comments',
+		'format_oneline_comments',
+		'no_reformat_patterns',
+		'trim_trailing_backslash',
+		'comment_open',
+		'comment_indent_ws',
+		'comment_indent_adjustment',
+		'ends_with_open_comment',
+		'starts_with_open_comment',
+		'slash_slash_comment',
+		'preprocessor_line',
+		'if_stack',
+		'non_ws_line',
+		'non_ws_line_started',
+		'empty',
+		'line_num',
+		'whitespace_width',
+		'whitespaces',
+		)
+
 	def __init__(self, config, log_handler):
 		self.log_handler = log_handler
 		self.format_slashslash_comments = config.format_comments.slashslash
 		self.format_multiline_comments = config.format_comments.multiline
 		self.format_oneline_comments = config.format_comments.oneline
-		self.no_reformat_patterns = config.no_reformat_patterns
+		self.no_reformat_patterns = combine_match_patterns(config.no_reformat_patterns)
 		self.trim_trailing_backslash = config.trim_trailing_backslash
 
 		# Set to True when a line is joined to the next with a /* */ comment which crosses EOL
@@ -1964,13 +2397,16 @@ class pre_parsing_state:
 				return LINE_INDENT_KEEP_CURRENT
 			if not self.format_multiline_comments:
 				return LINE_INDENT_KEEP_CURRENT
-			if self.whitespace_width == 0:
+			whitespace_width = self.whitespace_width
+			if whitespace_width == 0:
 				return LINE_INDENT_KEEP_CURRENT
-			if self.comment_indent_ws is None \
-				or not self.whitespaces.startswith(self.comment_indent_ws):
+			comment_indent_ws = self.comment_indent_ws
+			if comment_indent_ws is None \
+				or not self.whitespaces.startswith(comment_indent_ws):
 				return LINE_INDENT_KEEP_CURRENT
-			if self.whitespace_width > self.comment_indent_adjustment:
-				return self.whitespace_width - self.comment_indent_adjustment
+			comment_indent_adjustment = self.comment_indent_adjustment
+			if whitespace_width > comment_indent_adjustment:
+				return whitespace_width - comment_indent_adjustment
 			return 0
 
 		if self.non_ws_line_started:
@@ -2006,22 +2442,32 @@ class pre_parsing_state:
 
 	def tokenize_c_line(self, partial_lines:parse_partial_lines):
 
-		ii = iter(partial_lines)
-		next_c = next(ii, None)
+		# 'i' is the index of the lookahead character.
+		# The lists are parallel: char_lines and char_positions are only read
+		# when a token starts or a line needs to be passed on
+		chars, char_lines, char_positions, text = partial_lines.get_chars()
+		match_alphanumeric_run = alphanumeric_run_pattern.match
+		i = 0
 		identifier_token = bytearray()
 		lines = []
-
-		while next_c[0] is not None:
+		# Without continuation lines, only the trailing BACKSLASH_SEPARATOR and EOL
+		# can end a comment early. The rest of the comment can be skipped at once then
+		single_line = len(partial_lines.lines) == 1
+		last_index = len(chars) - 1
+		if chars[last_index - 1] is BACKSLASH_SEPARATOR:
+			last_index -= 1
+
+		# Only lines which need to be passed to the token interpreter are put to 'lines'.
+		# Character positions are only read at a token start.
+		while 1:
 			while lines:
 				# Need to pass lines to the token interpreter
-				line = lines.pop(0)
-				if line is not None:
-					yield SPACE, None, line
+				yield SPACE, None, lines.pop(0)
 				continue
 
-			c, line, character_pos = next_c
-
-			next_c = next(ii, None)
+			c = chars[i]
+			line = char_lines[i]
+			i += 1
 
 			if c is BACKSLASH_SEPARATOR:
 				yield c, None, line
@@ -2031,39 +2477,55 @@ class pre_parsing_state:
 				yield None, None, line
 				break
 
-			lines.append(line)
+			if line is not None:
+				lines.append(line)
 
-			if c == SPACE or c == TAB:
+			# 'c' is a source byte here
+			char_class = char_class_table[c]
+			if char_class == CHAR_CLASS_WHITESPACE:
 				continue
 
 			if self.slash_slash_comment:
 				# Need to process the whole line
+				if single_line:
+					i = last_index
 				continue
 
 			self.empty = False
 
 			if self.comment_open:
 				# Look for the next */
-				if c == ASTERISK and next_c[0] == SLASH:
+				if single_line:
+					i = text.find(b'*/', i - 1, last_index) + 2
+					if i == 1:
+						i = last_index
+					else:
+						self.comment_open = False
+					continue
+
+				if c == ASTERISK and chars[i] == SLASH:
 					# Need to pass lines to the token interpreter
-					lines.append(next_c[1])
+					if char_lines[i] is not None:
+						lines.append(char_lines[i])
 
-					next_c = next(ii, None)
+					i += 1
 					self.comment_open = False
 				continue
 
-			if c == SLASH:
-				if next_c[0] == SLASH:
+			if char_class == CHAR_CLASS_SLASH:
+				if chars[i] == SLASH:
 					self.slash_slash_comment = True
 					# Any continuation lines will keep their indents and backslashes
 					# Consume all characters
-					lines.append(next_c[1])
-					next_c = next(ii, None)
+					if char_lines[i] is not None:
+						lines.append(char_lines[i])
+					i += 1
 					continue
-				if next_c[0] == ASTERISK:
+				if chars[i] == ASTERISK:
 					self.comment_open = True
-					lines.append(next_c[1])
-					next_c = next(ii, None)
+					if char_lines[i] is not None:
+						lines.append(char_lines[i])
+					i += 1
 					continue
 
 			if not self.non_ws_line_started:
@@ -2073,68 +2535,86 @@ class pre_parsing_state:
 					self.preprocessor_line = b'#'
 					continue
 
-			token_position = character_pos
+			token_position = char_positions[i - 1]
+			# If not None, token_line is the first item in 'lines'
+			token_line = line
 
 			if c == WIDE_STRING_PREFIX and \
-				(next_c[0] == DOUBLE_QUOTE or next_c[0] == SINGLE_QUOTE):
-				c, line, _ = next_c
+				(chars[i] == DOUBLE_QUOTE or chars[i] == SINGLE_QUOTE):
+				c = chars[i]
+				char_class = CHAR_CLASS_QUOTE
+				line = char_lines[i]
 				if line is not None:
 					lines.append(line)
-				next_c = next(ii, None)
+				i += 1
 
-			if c == DOUBLE_QUOTE or c == SINGLE_QUOTE:
+			if char_class == CHAR_CLASS_QUOTE:
 				cc = c
-				while next_c[0] is not EOL:
-					c, line, _ = next_c
+				while chars[i] is not EOL:
+					c = chars[i]
+					line = char_lines[i]
 					if line is not None:
 						lines.append(line)
 						line.indent = LINE_INDENT_KEEP_CURRENT_NO_RETAB
-					next_c = next(ii, None)
+					i += 1
 					if cc == c:
 						break
 					if c == BACKSLASH:
-						next_c = next(ii, None)
+						i += 1
 					continue
 
 				if c == DOUBLE_QUOTE:
-					yield STRING_LITERAL, token_position, lines.pop(0)
+					yield STRING_LITERAL, token_position, lines.pop(0) if token_line is not None else None
 				else:
-					yield QUOTED_LITERAL, token_position, lines.pop(0)
+					yield QUOTED_LITERAL, token_position, lines.pop(0) if token_line is not None else None
 
 				continue
 
-			if is_alphanumeric(c):
+			if char_class == CHAR_CLASS_ALPHANUMERIC:
 				if self.preprocessor_line:
 					if self.preprocessor_line != b'#':
-						# Don't care about other alphanumeric tokens in a preprocessor line
+						# Don't care about other alphanumeric tokens in a preprocessor line.
+						# Skip the rest of the run at once
+						i = match_alphanumeric_run(text, i).end()
 						continue
-					# Beginning of the very first token after pound sign
-					identifier_token += b'#'
-
-				while 1:
-					identifier_token.append(c)
-					c, line, _ = next_c
-					if c is BACKSLASH_SEPARATOR:
-						next_c = next(ii, None)
-						if not is_alphanumeric(next_c[0]):
+				# A run of alphanumeric characters is taken in one step.
+				# No line begins inside the run, only after BACKSLASH_SEPARATOR
+				start = i - 1
+				i = match_alphanumeric_run(text, i).end()
+				token = text[start:i]
+				c = chars[i]
+				line = char_lines[i]
+				if c is BACKSLASH_SEPARATOR:
+					identifier_token += token
+					while c is BACKSLASH_SEPARATOR:
+						i += 1
+						# BACKSLASH_SEPARATOR and EOL are not alphanumeric in 'text'
+						if not alphanumeric_table[text[i]]:
 							break
+						# Next line whitespaces must be zero
+						if line is not None: lines.append(line)
+						# The first character of the next line is stored twice
+						c = chars[i]
+						identifier_token.append(c)
+						line = char_lines[i]
 						if line is not None: lines.append(line)
-						c, line, _ = next_c
+						start = i
+						i = match_alphanumeric_run(text, i + 1).end()
+						identifier_token += text[start:i]
+						c = chars[i]
+						line = char_lines[i]
 						continue
-						# Next line whitespaces must be zero
-					elif not is_alphanumeric(c):
-						break
-					if line is not None: lines.append(line)
-					next_c = next(ii, None)
-					continue
 
-				token = bytes(identifier_token)
-				identifier_token.clear()
+					token = bytes(identifier_token)
+					identifier_token.clear()
+
 				if self.preprocessor_line is None:
-					token = decode_alphanumeric_token(token)
+					# Keywords and repeated identifiers are found without a call
+					token = alphanum_token_cache.get(token) or decode_alphanumeric_token(token)
 				else:
-					token = decode_preprocessor_token(token)
-				yield token, token_position, lines.pop(0)
+					# The very first token after pound sign
+					token = decode_preprocessor_token(b'#' + token)
+				yield token, token_position, lines.pop(0) if token_line is not None else None
 
 				if c is BACKSLASH_SEPARATOR:
 					# An alphanumeric token ends at a backslash separator
@@ -2151,27 +2631,50 @@ class pre_parsing_state:
 
 			# Note that we don't yield 'c' itself, but the
 			# global constant, to be able to match it by 'is' operator
-			token = operator_dict.get(c, c)
+			token = operator_table[c]
+			if type(token) is dict and single_line:
+				# No line starts or separators inside the operator.
+				# operator_dict is at most three levels deep, its walk is unrolled here.
+				# BACKSLASH_SEPARATOR and EOL in 'text' are not operator bytes
+				next_token = token.get(text[i])
+				if next_token is None:
+					token = token[None]
+				else:
+					i += 1
+					if type(next_token) is dict:
+						token = next_token.get(text[i])
+						if token is None:
+							token = next_token[None]
+						else:
+							i += 1
+					else:
+						token = next_token
+
 			while type(token) is dict:
-				c, line, _ = next_c
-				if c is BACKSLASH_SEPARATOR:
-					next_c = next(ii, None)
-					if next_c[0] not in token:
+				c = chars[i]
+				line = char_lines[i]
+				next_token = token.get(c)
+				if next_token is not None:
+					token = next_token
+				elif c is BACKSLASH_SEPARATOR:
+					i += 1
+					if chars[i] not in token:
 						token = token[None]
 						break
 					if line is not None: lines.append(line)
-					c, line, _ = next_c
-				elif c not in token:
+					c = chars[i]
+					line = char_lines[i]
+					token = token[c]
+				else:
 					token = token[None]
 					break
 
-				token = token[c]
 				if line is not None:
 					lines.append(line)
-				next_c = next(ii, None)
+				i += 1
 				continue
 
-			yield token, token_position, lines.pop(0)
+			yield token, token_position, lines.pop(0) if token_line is not None else None
 			if c is BACKSLASH_SEPARATOR:
 				# An alphanumeric token ends at a backslash separator
 				while lines:
@@ -2241,6 +2744,7 @@ class pre_parsing_state:
 
 def format_c_file(fd_in, config, error_handler=format_err_handler):
 	preproc_if_nesting = []
+	buffer = bytearray()
 
 	for lines_to_write, pp_state, c_state in parse_c_file(fd_in, config, error_handler):
 
@@ -2249,51 +2753,55 @@ def format_c_file(fd_in, config, error_handler=format_err_handler):
 
 		pp_state.finalize_lines(lines_to_write, c_state)
 
-		yield from write_partial_lines(lines_to_write)
+		write_partial_lines(lines_to_write, buffer)
+		if len(buffer) >= WRITE_BLOCK_SIZE:
+			yield buffer
+			buffer = bytearray()
 		continue
 
+	if buffer:
+		yield buffer
 	return
 
-def read_and_fix_lines(fd : io.BytesIO, config):
+# Lines are read in blocks of about this many bytes
+READ_BLOCK_SIZE = 0x10000
+
+# A standalone CR (not followed by LF) is a line separator.
+# All alternatives begin with the CR, for the search to skip quickly to the next one
+stray_cr_pattern = re.compile(rb'\r(?:(?P<last>\Z)|(?<=\n\r)(?<!\r\n\r)(?P<after_lf>)(?!\n)|(?!\n))')
+
+def replace_stray_cr(m):
+	if m.lastgroup == 'last':
+		# Last line in the file ends with a single CR
+		return b'\r\n'
+	if m.lastgroup == 'after_lf':
+		# If a line has a CR in the first character, and previous line has a single LF in the end,
+		# treat it as a single LF CR line separator
+		return b''
+	return b'\n'
+
+def read_and_fix_line_blocks(fd : io.BytesIO, config):
 	fix_cr_eol = config.fix_eol
 	fix_last_eol = config.fix_last_eol
 
 	if not (fix_cr_eol or fix_last_eol):
-		for line in fd:
-			yield line
+		# format_data passes an in-memory io.BytesIO, no system calls are made here.
+		# readlines() splits a whole block in one call
+		while (lines := fd.readlines(READ_BLOCK_SIZE)):
+			yield lines
 		return
 
-	cr_pattern = re.compile(b'\r(?!\n)')
-	prev_lf = False
-
-	for line in fd:
-		ends_crlf = line.endswith(b'\r\n')
+	# Fix stray CR characters over the whole file at once
+	data = stray_cr_pattern.sub(replace_stray_cr, fd.read())
+	if fix_last_eol and data and not data.endswith(b'\n'):
+		data += b'\n'
+	# Only CR LF pairs are left, they're not split
+	yield data.splitlines(keepends=True)
+	return
 
-		if ends_crlf and line.find(b'\r', 0, len(line) - 2) == -1:
-			yield line
-		elif not ends_crlf and line.find(b'\r') == -1:
-			if fix_last_eol and not line.endswith(b'\n'):
-				line += b'\n'
-			yield line
-		else:
-			if line.endswith(b'\r'):
-				# Last line in the file ends with a single CR
-				line += b'\n'
-			elif fix_last_eol and not line.endswith(b'\n'):
-				line += b'\n'
-
-			# Split by standalone CR
-			splitlines = cr_pattern.split(line)
-			# If line had a '\r' in the first character, and previous line had a single '\n' in the end,
-			# treat is a s single '\n\r' line separator
-			if prev_lf and len(splitlines[0]) == 0:
-				splitlines.pop(0)
-			# Append '\n' to lines split by '\r'
-			for i in range(len(splitlines)-1):
-				splitlines[i] += b'\n'
-			yield from splitlines
-
-		prev_lf = not ends_crlf
+def read_and_fix_lines(fd : io.BytesIO, config):
+	for lines in read_and_fix_line_blocks(fd, config):
+		yield from lines
 		continue
 	return
 
@@ -2326,7 +2834,10 @@ def parse_c_file(fd : io.BytesIO,
 
 	pp_state = pre_parsing_state(config, log_handler)
 	c_state = c_parser_state(config)
+	process_token = c_state.process_token
 	lines_to_write = []
+	append_line = lines_to_write.append
+	trim_trailing_backslash = config.trim_trailing_backslash
 
 	for partial_lines in read_partial_lines(fd, config):
 
@@ -2342,6 +2853,8 @@ def parse_c_file(fd : io.BytesIO,
 		pp_state.init_new_line(first_line, c_state)
 		lines_to_write.clear()
 
+		# Tokens are pulled one at a time: handling BACKSLASH_SEPARATOR below
+		# calls init_new_line, which changes the tokenizer state for the rest of the line
 		token_iter = pp_state.tokenize_c_line(partial_lines)
 
 		# We have the next token for lookahead
@@ -2353,21 +2866,14 @@ def parse_c_file(fd : io.BytesIO,
 			token, c_state.token_position, line = next_token
 
 			if line is not None:
-				lines_to_write.append(line)
+				append_line(line)
 				if line.non_ws_line:
 					pp_state.empty = False
 
 			next_token = next(token_iter, None)	# Never None
 
 			if pp_state.preprocessor_line:
-				if token is PREPROCESSOR_LINE or \
-						token is IF_LINE or \
-						token is ELSE_LINE or \
-						token is ELIF_LINE or \
-						token is IFDEF_LINE or \
-						token is IFNDEF_LINE or \
-						token is DEFINE_LINE or \
-						token is ENDIF_LINE:
+				if token in PREPROCESSOR_LINE_TOKENS:
 					pp_state.preprocessor_line = token
 					pp_state.non_ws_line = lines_to_write[-1].non_ws_line
 				# Consume all tokens, including BACKSLASH_SEPARATOR
@@ -2382,7 +2888,7 @@ def parse_c_file(fd : io.BytesIO,
 				# Only the first token in a line after trailing backslash can be SPACE
 				c_state.next_token = next_token[0]
 
-				if not config.trim_trailing_backslash or c_state.inline_asm:
+				if not trim_trailing_backslash or c_state.inline_asm:
 					continue
 
 				last_line = lines_to_write[-1]
@@ -2413,10 +2919,12 @@ def parse_c_file(fd : io.BytesIO,
 				c_state.next_token = None
 				c_state.next_token_position = None
 			else:
+				# The handlers read the lookahead token from c_state,
+				# it has to be stored there for every token
 				token = c_state.next_token	# Can be changed by previous token handler
 				c_state.next_token, c_state.next_token_position, _ = next_token
 
-			c_state.process_token(token)
+			process_token(token)
 			continue
 
 		yield lines_to_write, pp_state, c_state
@@ -2425,6 +2933,7 @@ def parse_c_file(fd : io.BytesIO,
 	return
 
 def fix_file_lines(in_fd, config):
+	buffer = bytearray()
 
 	for line in read_and_fix_lines(in_fd, config):
 		p = parse_line(line, config)
@@ -2432,17 +2941,56 @@ def fix_file_lines(in_fd, config):
 			line_indent = LINE_INDENT_KEEP_CURRENT
 		else:
 			line_indent = LINE_INDENT_KEEP_CURRENT_NO_RETAB
-		yield p.make_line(line_indent)
+		buffer += p.make_line(line_indent)
+		if len(buffer) >= WRITE_BLOCK_SIZE:
+			yield buffer
+			buffer = bytearray()
+
+	if buffer:
+		yield buffer
 	return
 
+# Whitespace before an end of line, which fix_file_lines may trim
+trailing_whitespace_pattern = re.compile(rb'[ \t]\r?(?:\n|\Z)')
+lone_cr_pattern = re.compile(rb'\r(?!\n)')
+
+# Returns True if fix_file_lines would return the data unchanged, without retabbing
+def is_data_fixed(data, format_spec):
+	if format_spec.trim_trailing_whitespace and trailing_whitespace_pattern.search(data):
+		return False
+	# read_and_fix_line_blocks fixes stray CR for either option
+	if (format_spec.fix_eol or format_spec.fix_last_eol) and lone_cr_pattern.search(data):
+		return False
+	if format_spec.fix_last_eol and data and not data.endswith(b'\n'):
+		return False
+	return True
+
 def format_data(data, format_spec, error_handler=None):
 	if not format_spec.skip_indent_format and not format_spec.retab_only:
 		yield from format_c_file(io.BytesIO(data), format_spec, error_handler)
-	elif format_spec.trim_trailing_whitespace or format_spec.fix_eol or format_spec.retab_only:
+	elif format_spec.retab_only or ((format_spec.trim_trailing_whitespace or format_spec.fix_eol)
+									and not is_data_fixed(data, format_spec)):
 		yield from fix_file_lines(io.BytesIO(data), format_spec)
 	else:
 		yield data
 
+def format_file(input_filename, output_filename, conf, quiet):
+	# Read data _before_ opening the output file, to allow processing in place.
+	# The file can't be memory-mapped instead, because opening the output truncates it.
+	# io.BytesIO in format_data shares the bytes object without copying it
+	data = Path.read_bytes(input_filename)
+
+	def error_handler(s):
+		print("File %s: %s" % (input_filename, s),file=sys.stderr)
+		return
+
+	with open(output_filename, 'wb') as out_fd:
+		if not quiet:
+			print("Formatting: %s" % input_filename, file=sys.stderr)
+		out_fd.writelines(format_data(data, conf, error_handler))
+
+	return
+
 def get_style_str(style):
 	if not style:
 		return 'None'
@@ -2462,6 +3010,8 @@ def get_style_str(style):
 
 	return '+'.join(result)
 
+glob_magic_pattern = re.compile(r'[*?[]')
+
 def get_file_list(glob_list, input_directory, output_path):
 	file_list = []
 	output_filename = None
@@ -2482,8 +3032,15 @@ def get_file_list(glob_list, input_directory, output_path):
 
 	import glob
 	for spec in glob_list:
-		input_spec = Path(input_directory, spec)
-		for filename in glob.iglob(str(input_spec), recursive=True):
+		input_spec = str(Path(input_directory, spec))
+		if glob_magic_pattern.search(input_spec) is None:
+			# A plain filename doesn't need a glob pass,
+			# is_file() below is the only check needed
+			filenames = (input_spec,)
+		else:
+			filenames = glob.iglob(input_spec, recursive=True)
+
+		for filename in filenames:
 			# Split the directory prefix
 			filename = Path(filename)
 			if not filename.is_file():
@@ -2585,6 +3142,8 @@ def main():
 					help="Use formatting configuration from an XML file")
 	parser.add_argument("--project",
 					help="Select <Project> section for formatting configuration from an XML file")
+	parser.add_argument("--jobs", '-j', type=int, default=1, metavar='N',
+					help="Format up to N files in parallel, default 1")
 
 	options = parser.parse_args()
 
@@ -2630,6 +3189,9 @@ def main():
 		no_reformat_patterns = [],
 		tabs = options.style == 'tabs')
 
+	# Keyed by the resolved output filename. A file matched more than once
+	# must not be written by two worker processes at the same time
+	pending_files = {}
 	for file in file_list:
 		if project_cfgs_list:
 			# Path match patterns assume paths with slashes
@@ -2652,33 +3214,43 @@ def main():
 			and not conf.trim_trailing_whitespace and not conf.fix_eol):
 				continue
 
-		# Read data _before_ opening the output file, to allow processing in place
-		data = Path.read_bytes(file.input_filename)
+		if file.output_filename:
+			if options.jobs > 1:
+				# The worker processes get a plain copy of the configuration,
+				# without the path match object
+				pending_files.setdefault(Path(file.output_filename).resolve(),
+							(file.input_filename, file.output_filename,
+							SimpleNamespace(**{name : value for name, value in vars(conf).items() if name != 'paths'}),
+							options.quiet))
+			else:
+				format_file(file.input_filename, file.output_filename, conf, options.quiet)
+			continue
 
-		if not file.output_filename:
-			# open() can take a duplicated file descriptor
-			file.output_filename = os.dup(sys.stdout.fileno())
-			options.quiet = True
-			def error_handler(s):
-				print(s,file=sys.stderr)
-				return
-		else:
-			def error_handler(s):
-				print("File %s: %s" % (file.input_filename, s),file=sys.stderr)
-				return
+		# Standard output is written in order, by this process
+		data = Path.read_bytes(file.input_filename)
+		options.quiet = True
+		def error_handler(s):
+			print(s,file=sys.stderr)
+			return
 
-		with open(file.output_filename, 'wb') as out_fd:
-			if not options.quiet:
-				print("Formatting: %s" % file.input_filename, file=sys.stderr)
-			for data in format_data(data, conf, error_handler):
-				out_fd.write(data)
+		# open() can take a duplicated file descriptor
+		with open(os.dup(sys.stdout.fileno()), 'wb') as out_fd:
+			out_fd.writelines(format_data(data, conf, error_handler))
 
 		continue
 
+	if pending_files:
+		import concurrent.futures
+		with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as executor:
+			for _ in executor.map(format_file, *zip(*pending_files.values())):
+				continue
+
 	return 0
 
 import hashlib
-# SHA1 of this file is used to invalidate SHA1 map file if this file changes
+# SHA1 of this file is used to invalidate SHA1 map file if this file changes.
+# It's taken once per process, which is well under a millisecond.
+# It's not cached on disk, since a stale cache would defeat the purpose
 sha1 = hashlib.sha1(Path(__file__).read_bytes(),usedforsecurity=False).digest()
 
 if sys.version_info < (3, 8):
@@ -1801,6 +1801,8 @@ class project_history_tree(history_reader):
 			actions.append(project_config.history_revision_action(b'extract', extract_file[1], copyfrom_path=extract_file_path))
 
 		self.executor = async_executor()
+		# The default pool runs git hash-object, which waits for a child process
+		async_workitem.configure_pool(getattr(options, 'hash_jobs', None), io_bound=True)
 		self.futures_executor=concurrent.futures.ThreadPoolExecutor(max_workers=min(4, os.cpu_count()+ 1))
 		# Serialize all write-tree invocations into a single worker thread
 		self.write_tree_executor=concurrent.futures.ThreadPoolExecutor(max_workers=1)
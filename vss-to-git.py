@@ -65,6 +65,8 @@ def main():
 	parser.add_argument("--retab-only", default=False, action='store_true', help="Only convert existing indents to tabs or spaces.")
 	parser.add_argument("--no-indent-reformat", dest='skip_indent_format', default=False, action='store_true',
 					help="Don't reformat indentation in files matching <Formatting> specifications")
+	parser.add_argument("--hash-jobs", dest='hash_jobs', type=int, metavar='N',
+					help="Number of threads to hash and write files to Git; default depends on the number of CPUs")
 
 	options = parser.parse_args();
 